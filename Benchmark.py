@@ -0,0 +1,225 @@
+""" Benchmark for FastValveMaterial on synthetic PBR materials
+
+Generates material sets (color, AO, normal, metallic and roughness maps, or
+color, normal and ORM maps) at the requested sizes, converts them with the
+full pipeline for every thread count and reports throughput, peak memory and
+the time spent per stage. Results are saved as JSON and can be compared
+against a stored baseline, the exit code is 1 when a case got slower.
+
+Example:
+python Benchmark.py --sizes 512,2048 --count 4 --threads 1,4 --save baseline.json
+python Benchmark.py --sizes 512,2048 --count 4 --threads 1,4 --baseline baseline.json
+"""
+
+import argparse
+import configparser
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak memory isn't reported there
+    resource = None
+
+import FastValveMaterial as fvm
+
+LAYOUTS = ("split", "orm")
+STAGES = ("decode", "scale", "gamma", "packing", "mipmaps", "compression", "encode", "write")
+# Throughput may drop this much below the baseline before a case counts as a regression
+TOLERANCE = 0.10
+
+
+# /////////////////////
+# Synthetic materials
+# /////////////////////
+
+def noise(rng: np.random.Generator, size: int, octaves: int = 5) -> np.ndarray:
+    # Smooth value noise in 0..1, coarse octaves are upscaled with bilinear filtering
+    total = np.zeros((size, size), np.float32)
+    for octave in range(octaves):
+        cells = min(4 << octave, size)
+        layer = Image.fromarray(rng.random((cells, cells), dtype=np.float32), "F")
+        total += np.asarray(layer.resize((size, size), Image.Resampling.BILINEAR)) / 2 ** octave
+    total -= total.min()
+    return total / max(total.max(), 1e-6)
+
+def to_image(array: np.ndarray, mode: str) -> Image.Image:
+    return Image.fromarray(np.clip(np.rint(array * 255), 0, 255).astype(np.uint8), mode)
+
+def generate_material(folder: Path, name: str, size: int, layout: str, seed: int):
+    rng = np.random.default_rng(seed)
+    height = noise(rng, size)
+    # Normals from the height field gradient, in DirectX layout
+    dy, dx = np.gradient(height * size / 32)
+    normal = np.stack([-dx, dy, np.ones_like(height)], -1)
+    normal /= np.linalg.norm(normal, axis=-1, keepdims=True)
+    ao = 0.5 + 0.5 * height
+    roughness = noise(rng, size, 3)
+    metallic = (noise(rng, size, 2) > 0.6).astype(np.float32)
+    color = np.stack([noise(rng, size, 4) * 0.6 + 0.2 for _ in range(3)], -1)
+    to_image(color, "RGB").save(folder / f"{name}_D.tga")
+    to_image((normal + 1) / 2, "RGB").save(folder / f"{name}_N.tga")
+    if layout == "orm":
+        orm = np.stack([ao, roughness, metallic, np.ones_like(ao)], -1)
+        to_image(orm, "RGBA").save(folder / f"{name}_ORM.tga")
+    else:
+        to_image(ao, "L").save(folder / f"{name}_AO.tga")
+        to_image(roughness, "L").save(folder / f"{name}_R.tga")
+        to_image(metallic, "L").save(folder / f"{name}_M.tga")
+
+def material_set(root: Path, size: int, count: int, layout: str) -> Path:
+    # Sets are kept in the work folder and reused by later runs
+    folder = root / f"{layout}-{size}-{count}"
+    done = folder / ".complete"
+    if not done.exists():
+        shutil.rmtree(folder, ignore_errors=True)
+        folder.mkdir(parents=True)
+        for index in range(count):
+            generate_material(folder, f"bench{index:03}", size, layout, seed=size * 1000 + index)
+        done.touch()
+    return folder
+
+
+# /////////////////////
+# Runs
+# /////////////////////
+
+def write_config(path: Path, input_path: Path, output_path: Path, layout: str, threads: int, options: dict):
+    config = configparser.ConfigParser()
+    config.optionxform = str
+    config.read(Path(__file__).with_name("config.ini"))
+    config["Input"].update({"Format": "tga", "Path": str(input_path), "Recursive": "False", "Scale": "1.0",
+                            "Color": "_D", "Normal": "_N", "AO": "_ORM" if layout == "orm" else "_AO",
+                            "Roughness": "_R", "Metallic": "_M"})
+    config["Output"].update({"Path": str(output_path), "ExportImages": "False"})
+    config["Debug"].update({"ThreadCount": str(threads), "DebugMessages": "False", "PrintConfig": "False",
+                            "ORM": str(layout == "orm")})
+    for key, value in options.items():
+        section, option = key.split(".", 1)
+        config[section][option] = value
+    with open(path, "w") as f:
+        config.write(f)
+
+def peak_rss() -> float:
+    # Peak resident memory in MB of this process and of its largest child
+    if resource is None:
+        return None
+    scale = 1 if sys.platform == "darwin" else 1024
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * scale / 2 ** 20
+
+def run_case(config_path: str, connection):
+    # Runs in its own process so peak memory is measured per case
+    logging.getLogger().setLevel(logging.WARNING)
+    converter = fvm.FastValveMaterial(fvm.Config(config_path))
+    converter.config.force_rebuild = True
+    start = time.perf_counter()
+    converter.convert()
+    wall = time.perf_counter() - start
+    converted = len(list(converter.config.output_path.glob("*.vmt")))
+    connection.send({"wall": wall, "peak_rss_mb": peak_rss(), "stages": {stage: totals["wall"] for stage, totals in converter.profile.stages.items()},
+                     "converted": converted})
+    connection.close()
+
+def benchmark(work: Path, size: int, count: int, layout: str, threads: int, options: dict) -> dict:
+    input_path = material_set(work / "materials", size, count, layout)
+    output_path = work / "output"
+    shutil.rmtree(output_path, ignore_errors=True)
+    config_path = work / "benchmark.ini"
+    write_config(config_path, input_path, output_path, layout, threads, options)
+    receiver, sender = multiprocessing.Pipe(False)
+    process = multiprocessing.Process(target=run_case, args=(str(config_path), sender))
+    process.start()
+    sender.close()
+    result = receiver.recv()
+    process.join()
+    if result["converted"] < count:
+        print(f"Warning: only {result['converted']} of {count} materials were converted")
+    # Every material is written as three textures at the input size
+    megapixels = count * size * size * 3 / 1e6
+    return {"name": f"{layout}-{size}-x{count}-t{threads}", "layout": layout, "size": size, "count": count,
+            "threads": threads, "converted": result["converted"], "wall": round(result["wall"], 4),
+            "materials_per_s": round(count / result["wall"], 4),
+            "megapixels_per_s": round(megapixels / result["wall"], 4),
+            "peak_rss_mb": None if result["peak_rss_mb"] is None else round(result["peak_rss_mb"], 1),
+            "stages": {stage: round(result["stages"].get(stage, 0.0), 4) for stage in STAGES}}
+
+
+# /////////////////////
+# Report
+# /////////////////////
+
+def print_case(case: dict):
+    rss = "n/a" if case["peak_rss_mb"] is None else f"{case['peak_rss_mb']:.0f} MB"
+    print(f"{case['name']:<24} {case['wall']:8.2f}s {case['materials_per_s']:8.2f} mat/s "
+          f"{case['megapixels_per_s']:8.2f} MP/s  peak {rss}")
+    # Stage times are summed over all workers, so they can add up to more than the wall time
+    total = sum(case["stages"].values()) or 1
+    print("    " + "  ".join(f"{stage} {seconds:.2f}s ({seconds / total:.0%})"
+                             for stage, seconds in case["stages"].items()))
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    # Names of the cases whose throughput dropped more than tolerance below the baseline
+    previous = {case["name"]: case for case in baseline["cases"]}
+    regressions = []
+    for case in results["cases"]:
+        if case["name"] not in previous:
+            continue
+        before = previous[case["name"]]["materials_per_s"]
+        change = case["materials_per_s"] / before - 1
+        print(f"{case['name']:<24} {before:8.2f} -> {case['materials_per_s']:8.2f} mat/s ({change:+.1%})")
+        if change < -tolerance:
+            regressions.append(case["name"])
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark FastValveMaterial on synthetic materials")
+    parser.add_argument("-s", "--sizes", default="512,1024,2048", help="Texture sizes, up to 8192")
+    parser.add_argument("-n", "--count", type=int, default=4, help="Materials per set")
+    parser.add_argument("-l", "--layouts", default=",".join(LAYOUTS), help="Map layouts (split, orm)")
+    parser.add_argument("-t", "--threads", default=f"1,{os.cpu_count()}", help="Thread counts to run")
+    parser.add_argument("-O", "--option", action="append", default=[],
+                        help="Extra config.ini setting for every run, e.g. Debug.Encoder=python")
+    parser.add_argument("-w", "--work", help="Folder for the generated materials, kept between runs")
+    parser.add_argument("-o", "--save", help="Save the results as JSON")
+    parser.add_argument("-b", "--baseline", help="Compare against saved results, exit code 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="Allowed slowdown (0.1 = 10%%)")
+    args = parser.parse_args()
+
+    options = dict(option.split("=", 1) for option in args.option)
+    work = Path(args.work) if args.work else Path(tempfile.gettempdir()) / "fvm-benchmark"
+    work.mkdir(parents=True, exist_ok=True)
+    results = {"version": fvm.version, "machine": {"platform": platform.platform(), "cpus": os.cpu_count(),
+                                                   "python": platform.python_version()},
+               "options": options, "cases": []}
+    for layout in args.layouts.split(","):
+        for size in (int(size) for size in args.sizes.split(",")):
+            for threads in (int(threads) for threads in args.threads.split(",")):
+                case = benchmark(work, size, args.count, layout, threads, options)
+                print_case(case)
+                results["cases"].append(case)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print(f"Slower than the baseline: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
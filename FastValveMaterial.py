@@ -2,6 +2,7 @@
 
 Prerequisites (Python 3.x):
 pillow
+numpy
 
 MIT License
 
@@ -30,25 +31,44 @@ import configparser
 
 import os
 import sys
-import glob
 import shutil
+import signal
 import sys
 import logging
 import json
+import hashlib
+import tempfile
+import threading
+import time
 import argparse
 import multiprocessing
-from urllib.request import urlopen
+import numbers
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+import ctypes
+from io import BytesIO
 from ctypes import create_string_buffer
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
 from enum import Enum
+from functools import lru_cache
 
+import numpy as np
 from PIL import Image, ImageChops, ImageOps
 
-import VTFLibWrapper.VTFLib as VTFLib
-import VTFLibWrapper.VTFLibEnums as VTFLibEnums
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, the peak comes from GetProcessMemoryInfo there
+    resource = None
+
+import ImageReaders
+import VPKWriter
+import VTFWriter
+from VTFWriter import ImageFormat, ImageFlag
 
-vtf_lib = VTFLib.VTFLib()
 version = "240213"
 
 class TextureType(Enum):
@@ -56,15 +76,33 @@ class TextureType(Enum):
     NORMAL = 'n'
     EXPONENT = 'm'
 
+# Source maps each output texture is built from
+TEXTURE_MAPS = {
+    TextureType.DIFFUSE: {"color", "ao", "metallic", "gloss"},
+    TextureType.NORMAL: {"normal", "gloss"},
+    TextureType.EXPONENT: {"gloss"},
+}
+# Value of the ao, metallic and gloss maps when there is no file (or channel) for them
+MAP_DEFAULTS = {"ao": 255, "metallic": 0, "gloss": 255}
+# Decoded forms of the maps of every texture that are kept in the material cache
+TEXTURE_FORMS = {
+    TextureType.DIFFUSE: ("color", "ao", "metallic", "gloss"),
+    TextureType.NORMAL: ("normal", "gloss_gamma"),
+    TextureType.EXPONENT: ("gloss",),
+}
+
+
+# Referenced by the VMTs when Phongwarps is on, copied next to them
+PHONGWARP_PATH = os.path.join(os.path.dirname(__file__), "phongwarp_steel.vtf")
 
 VMT_TEMPLATE = """// Generated by FastValveMaterial v{version} 
 // Forked by hampta because the original sucks
 // METALNESS: "{metallic_factor}" GAMMA: "{midtone}"
 "VertexLitGeneric"
 {{
-    "$basetexture" "{output_path}/{material_name}_c"
-    "$bumpmap" "{output_path}/{material_name}_n"
-    "$phongexponenttexture" "{output_path}/{material_name}_m"
+    "$basetexture" "{output_path}/{textures[c]}"
+    "$bumpmap" "{output_path}/{textures[n]}"
+    "$phongexponenttexture" "{output_path}/{textures[m]}"
     "$color2" "[ .1 .1 .1 ]"
     "$blendtintbybasealpha" "1"
     "$phong" "1"
@@ -83,9 +121,9 @@ VMT_NORMAL_TEMPLATE = """// Generated by FastValveMaterial v{version}
 // NORMALIZED MATERIAL!
 "VertexLitGeneric"
 {{
-    "$basetexture" "{output_path}/{material_name}_c"
-    "$bumpmap" "{output_path}/{material_name}_n"
-    "$phongexponenttexture" "{output_path}/{material_name}_m"
+    "$basetexture" "{output_path}/{textures[c]}"
+    "$bumpmap" "{output_path}/{textures[n]}"
+    "$phongexponenttexture" "{output_path}/{textures[m]}"
     "$phong" "1"
     "$phongboost" "1"
     "$color2" "[ 0 0 0 ]"
@@ -106,12 +144,104 @@ PROXIES_TEMPLATE = """\
         }
     }"""
 
+# Maps a preset can route a channel into, and the role they fill. Roughness is inverted into gloss
+ROUTE_TARGETS = {"ao": "ao", "metallic": "metallic", "roughness": "gloss", "gloss": "gloss"}
+CHANNELS = "RGBA"
+# Source names that are the map files of [Input], presets can add packed files of their own
+MAP_SOURCES = ("color", "ao", "normal", "metallic", "roughness")
+# ORM = True: the AO map is an ORM map (UE4 layout)
+ORM_ROUTES = {"ao": ("ao", "R"), "roughness": ("ao", "G"), "metallic": ("ao", "B")}
+
+def parse_preset(options: dict) -> tuple:
+    # A [Preset.<name>] section: "target = source.channel" routes a channel, anything
+    # else adds a packed source file by its suffix, e.g. "orm = _ORM"
+    sources, routes = {}, {}
+    for key, value in options.items():
+        if key not in ROUTE_TARGETS:
+            sources[key] = value.strip()
+            continue
+        source, _, channel = value.strip().rpartition(".")
+        if not source or len(channel) != 1 or channel.upper() not in CHANNELS:
+            raise ValueError(f"Channel route '{key} = {value}' should look like 'source.R' (R, G, B or A)")
+        routes[key] = (source.lower(), channel.upper())
+    if "roughness" in routes and "gloss" in routes:
+        raise ValueError("A preset can route roughness or gloss, not both")
+    for source, _ in routes.values():
+        if source not in sources and source not in MAP_SOURCES:
+            raise ValueError(f"Unknown source '{source}' in preset, add it as '{source} = <suffix>'")
+    return sources, routes
+
+def parse_profile(name: str, options: dict) -> "Profile":
+    # [Profile.<name>] section: Scale is 1, 0.5, 0.25, ... so the profile is a mip level of the full texture
+    scale = float(options.get("scale", "0.5"))
+    inverse = 1 / scale if 0 < scale <= 1 else 0
+    if not inverse or inverse != int(inverse) or int(inverse) & (int(inverse) - 1):
+        raise ValueError(f"Scale of profile '{name}' must be 1, 0.5, 0.25, ..., not {options.get('scale')}")
+    return Profile(name, scale, int(options.get("maxsize", "0")), Path(options["path"]) if options.get("path") else None)
+
+def enum_setting(name: str, enum_type, value: str):
+    # Enum member from its name in any case, e.g. "lanczos" -> MipFilter.LANCZOS
+    try:
+        return enum_type[value.upper()]
+    except KeyError:
+        raise ValueError(f"{name} must be one of {', '.join(member.name.lower() for member in enum_type)}, "
+                         f"not '{value}'") from None
+
+def setting_value(name: str, current, value):
+    # value as the type of the current field, strings are parsed like the values of config.ini
+    if isinstance(current, Enum) and isinstance(value, str):
+        return enum_setting(name, type(current), value)
+    try:
+        if isinstance(current, Enum):
+            return type(current)(value)
+        if isinstance(current, bool):
+            if isinstance(value, str):
+                value = configparser.ConfigParser.BOOLEAN_STATES[value.strip().lower()]
+            if isinstance(value, numbers.Integral) and value in (0, 1):
+                return bool(value)
+        elif isinstance(current, int):
+            value = int(value) if isinstance(value, str) else value
+            if isinstance(value, numbers.Integral) and not isinstance(value, bool):
+                return int(value)
+        elif isinstance(current, float):
+            value = float(value) if isinstance(value, str) else value
+            if isinstance(value, numbers.Real) and not isinstance(value, bool):
+                return float(value)
+        elif name.endswith("_path"):
+            return None if value is None else Path(value)
+        elif isinstance(current, str):
+            if isinstance(value, str):
+                return value.lower() if name in SETTING_CHOICES else value
+        else:
+            return value
+    except (KeyError, ValueError, TypeError):
+        pass
+    raise ValueError(f"{name} must be of type {type(current).__name__}, not {value!r}")
+
+# Settings used where config.ini (or the file given to Config) doesn't set them
+DEFAULT_CONFIG = {
+    "Input": {"Format": "tga", "Scale": "1.0", "Color": "_D", "Normal": "_N", "Metallic": "_M", "Roughness": "_R",
+              "AO": "_AO", "NormalFormat": "directx", "Path": "./images/", "Recursive": "False", "Preset": ""},
+    "Output": {"Path": "./fastvalvematerial/", "Midtone": "235", "ExportImages": "False", "ExportFormat": "tga",
+               "ExportMipmaps": "False", "MaterialSetup": "rough", "Deduplicate": "link", "ShrinkUniform": "True",
+               "Profiles": "", "Package": "", "PackageVersion": "2", "PackageChunkSize": "200"},
+    "Debug": {"ThreadCount": "2", "DebugMessages": "False", "PrintConfig": "False", "ForceCompression": "True",
+              "FastExport": "False", "ClearExponent": "False", "MetallicFactor": "210", "MaterialProxies": "False",
+              "ORM": "False", "Phongwarps": "True", "PackingEngine": "numpy", "Encoder": "auto",
+              "CompressionQuality": "range", "MipmapFilter": "box", "NormalizeMipmaps": "True", "AlphaCoverage": "0",
+              "MaxMemory": "0", "CachePath": "", "Profile": ""},
+}
+
 class Config:
     def __init__(self, file="config.ini"):
+        # file = None only uses the defaults, e.g. for convert_material()
         __config = configparser.ConfigParser()
-        __config.read(file)
+        __config.read_dict(DEFAULT_CONFIG)
+        if file is not None:
+            __config.read(file)
         # Input
-        self.input_format = __config["Input"]["Format"]
+        self.input_formats = [f.strip().lower() for f in __config["Input"]["Format"].split(",") if f.strip()]
+        self.input_recursive = __config["Input"].getboolean("Recursive", False)
         self.input_scale = __config["Input"].getfloat("Scale")
         self.input_color = __config["Input"]["Color"]
         self.input_ao = __config["Input"]["AO"]
@@ -119,11 +249,19 @@ class Config:
         self.input_metallic = __config["Input"]["Metallic"]
         self.input_roughness = __config["Input"]["Roughness"]
         self.input_path = Path(__config["Input"]["Path"])
+        self.preset = __config["Input"]["Preset"].strip()
         # Output
         self.output_path = Path(__config["Output"]["Path"])
         self.midtone = __config["Output"].getint("Midtone")
         self.export_images = __config["Output"].getboolean("ExportImages")
-        self.material_setup = __config["Output"]["MaterialSetup"]
+        self.export_format = __config["Output"].get("ExportFormat", "tga").lower()
+        self.export_mipmaps = __config["Output"].getboolean("ExportMipmaps", False)
+        self.material_setup = __config["Output"]["MaterialSetup"].lower()
+        self.deduplicate = __config["Output"].get("Deduplicate", "link").lower()
+        self.shrink_uniform = __config["Output"].getboolean("ShrinkUniform", True)
+        self.package_path = Path(__config["Output"]["Package"].strip()) if __config["Output"]["Package"].strip() else None
+        self.package_version = __config["Output"].getint("PackageVersion")
+        self.package_chunk_size = __config["Output"].getint("PackageChunkSize")
         # Debug
         self.thread_count = __config["Debug"].getint("ThreadCount")
         self.debug_messages = __config["Debug"].getboolean("DebugMessages")
@@ -135,8 +273,62 @@ class Config:
         self.material_proxies = __config["Debug"].getboolean("MaterialProxies")
         self.orm = __config["Debug"].getboolean("ORM")
         self.phongwarps = __config["Debug"].getboolean("Phongwarps")
-        if self.thread_count == -1:
+        self.max_memory = __config["Debug"].getint("MaxMemory", 0)
+        self.cache_path = __config["Debug"].get("CachePath", "") or None
+        self.profile_path = Path(__config["Debug"]["Profile"]) if __config["Debug"].get("Profile") else None
+        self.force_rebuild = False
+        self.packing_engine = __config["Debug"].get("PackingEngine", "numpy").lower()
+        self.encoder = __config["Debug"].get("Encoder", "auto").lower()
+        self.compression_quality = enum_setting("compression_quality", VTFWriter.Quality,
+                                                __config["Debug"].get("CompressionQuality", "range"))
+        self.mip_filter = enum_setting("mip_filter", VTFWriter.MipFilter, __config["Debug"].get("MipmapFilter", "box"))
+        self.normalize_mipmaps = __config["Debug"].getboolean("NormalizeMipmaps", True)
+        self.alpha_coverage = __config["Debug"].getint("AlphaCoverage", 0)
+        if self.thread_count <= 0:
+            self.thread_count = os.cpu_count()
+        # [Preset.<name>] sections by name, update() can switch between them
+        self.presets = {section[len("Preset."):]: dict(__config[section]) for section in __config.sections()
+                        if section.startswith("Preset.")}
+        self.update_routes()
+        # Smaller copies of every output, see [Profile.<name>]
+        self.profiles = []
+        for name in (name.strip() for name in __config["Output"]["Profiles"].split(",")):
+            if not name:
+                continue
+            if not __config.has_section(f"Profile.{name}"):
+                raise ValueError(f"Profile '{name}' needs a [Profile.{name}] section")
+            self.profiles.append(parse_profile(name, dict(__config[f"Profile.{name}"])))
+        self.validate()
+
+    def validate(self):
+        for name, choices in SETTING_CHOICES.items():
+            if getattr(self, name) not in choices:
+                raise ValueError(f"{name} must be one of {', '.join(map(str, choices))}, not '{getattr(self, name)}'")
+        if self.package_path is not None and not self.package_path.name.endswith("_dir.vpk"):
+            raise ValueError(f"Package has to end in _dir.vpk, not '{self.package_path}'")
+
+    def update_routes(self):
+        # Packed source files by name (suffix), and the channel each routed map is read from
+        self.channel_sources, self.channel_routes = {}, {}
+        if self.preset:
+            if self.preset not in self.presets:
+                raise ValueError(f"Preset '{self.preset}' needs a [Preset.{self.preset}] section")
+            self.channel_sources, self.channel_routes = parse_preset(self.presets[self.preset])
+        elif self.orm:
+            self.channel_routes = dict(ORM_ROUTES)
+
+    def update(self, settings: dict) -> "Config":
+        # Sets fields by name, e.g. {"material_setup": "gloss", "mip_filter": "lanczos"}
+        for name, value in settings.items():
+            if not hasattr(self, name):
+                raise ValueError(f"Unknown setting '{name}'")
+            setattr(self, name, setting_value(name, getattr(self, name), value))
+        if self.thread_count <= 0:
             self.thread_count = os.cpu_count()
+        if settings.keys() & {"orm", "preset", "presets"}:
+            self.update_routes()
+        self.validate()
+        return self
             
             
 @dataclass
@@ -147,13 +339,288 @@ class Material:
     normal_path: str = None
     metallic_path: str = None
     roughness_path: str = None
+    # Files of the packed sources of the preset, by source name
+    packed: dict = field(default_factory=dict)
     
     def list(self):
         return [self.color_path, self.ao_path, self.normal_path, self.metallic_path, self.roughness_path]
 
 
+@dataclass
+class Profile:
+    """ A smaller copy of every output in its own folder, built from the mip levels of the full size texture """
+    name: str
+    scale: float = 0.5
+    # Longest side in pixels, 0 = no limit
+    max_size: int = 0
+    # Output folder, <Output.Path>_<name> when not set
+    path: Path = None
+
+    def first_level(self, size: tuple) -> int:
+        # Mip level of a texture of this size that the profile's texture starts at
+        level = int(1 / self.scale).bit_length() - 1
+        while self.max_size and max(size[0] >> level, size[1] >> level) > self.max_size:
+            level += 1
+        return level
+
+
+def texture_name(material_name: str, texture_type: TextureType) -> str:
+    return f'{material_name}_{texture_type.value}.vtf'
+
+
+# Config fields each output depends on, a change to any of them rebuilds the output
+SHARED_SETTINGS = ("input_scale", "input_ao", "input_metallic", "input_roughness", "material_setup", "orm", "channel_routes",
+                   "force_compression", "fast_export", "export_images", "export_format", "export_mipmaps",
+                   "encoder", "compression_quality", "mip_filter", "alpha_coverage", "shrink_uniform", "profiles")
+OUTPUT_SETTINGS = {
+    TextureType.DIFFUSE: SHARED_SETTINGS + ("metallic_factor",),
+    TextureType.NORMAL: SHARED_SETTINGS + ("midtone", "normalize_mipmaps"),
+    TextureType.EXPONENT: SHARED_SETTINGS + ("clear_exponent",),
+    "vmt": ("output_path", "clear_exponent", "metallic_factor", "midtone", "phongwarps", "material_proxies", "profiles"),
+}
+MANIFEST_NAME = ".fvm_manifest.json"
+# Watch mode: quiet time before changed files are converted, and the polling interval without watchdog
+WATCH_DELAY = 0.3
+POLL_INTERVAL = 0.5
+# Watchdog events that change an input, opened and closed_no_write also come from the converter reading them
+WATCH_EVENTS = ("created", "modified", "deleted", "moved")
+# Bumped whenever the same inputs and settings start to give different outputs, so they're rebuilt
+OUTPUT_REVISION = 1
+# Formats ExportImages can write, mip levels below the top one get a _mip<level> suffix
+EXPORT_FORMATS = ("tga", "png")
+# How identical outputs of different materials are shared: "link" hard links the file,
+# "reference" points the VMT at the first material's texture, "off" builds every copy
+DEDUPLICATE_MODES = ("off", "link", "reference")
+# Values the string settings can take, checked for config.ini and Config.update() alike
+SETTING_CHOICES = {"deduplicate": DEDUPLICATE_MODES, "export_format": EXPORT_FORMATS,
+                   "material_setup": ("gloss", "rough"), "packing_engine": ("numpy", "pillow"),
+                   "encoder": ("auto", "vtflib", "python"), "package_version": (1, 2)}
+# Side of the textures written for maps that are a single color
+UNIFORM_SIZE = 4
+# Rough working set per output pixel while a band is packed and compressed
+BAND_BYTES_PER_PIXEL = 64
+# Threads writing finished outputs, and how many encoded bytes may wait for them
+# before the main process stops taking new results from the workers
+WRITE_THREADS = 2
+WRITE_QUEUE_BYTES = 256 * 2 ** 20
+
+
+def atomic_write(path: Path, data: bytes):
+    # Written to a temporary file next to the output and renamed over it, so readers
+    # (and an interrupted run) never see a half written file
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Created like open() does, so the permissions follow the umask
+    tmp_path = path.with_name(f".{path.name}.{os.urandom(4).hex()}.tmp")
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0), 0o666)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def output_files(output: Path) -> list:
+    # The VTF of an output and its exported images that exist
+    images = [path for extension in EXPORT_FORMATS for path in
+              (output.with_suffix(f".{extension}"), *output.parent.glob(f"{output.stem}_mip*.{extension}"))]
+    return [path for path in (output, *images) if path.exists()]
+
+def link_output(output_path: Path, source: str, target: str):
+    # Shares the files of an identical output as hard links, copied where the file system has none
+    source_stem, target_stem = Path(source).stem, Path(target).stem
+    target_folder = (output_path / target).parent
+    target_folder.mkdir(parents=True, exist_ok=True)
+    for path in output_files(output_path / source):
+        target_path = target_folder / (target_stem + path.name[len(source_stem):])
+        tmp_path = target_path.with_name(f".{target_path.name}.{os.getpid()}.tmp")
+        if tmp_path.exists():
+            tmp_path.unlink()
+        try:
+            os.link(path, tmp_path)
+        except OSError:
+            shutil.copyfile(path, tmp_path)
+        os.replace(tmp_path, target_path)
+
+def write_outputs(targets: dict, outputs: list, trace: bool) -> dict:
+    # Runs on a writer thread, returns a profiler snapshot with a single "write" stage.
+    # Timed by hand, the CPU time of the profiler counts every thread of the process
+    wall, cpu, start = time.perf_counter(), time.thread_time(), time.time()
+    for profile, name, data in outputs:
+        targets[profile].write(name, data)
+    duration = time.perf_counter() - wall
+    totals = {"wall": duration, "cpu": time.thread_time() - cpu, "read": 0,
+              "written": sum(len(data) for *_, data in outputs), "peak_rss": peak_rss()}
+    events = [{"stage": "write", "start": start, "duration": duration, "pid": os.getpid()}] if trace else None
+    return {"stages": {"write": totals}, "events": events}
+
+
+@lru_cache(maxsize=None)
+def phongwarp_data() -> bytes:
+    with open(PHONGWARP_PATH, "rb") as f:
+        return f.read()
+
+
+class OutputFolder:
+    """ Outputs written as loose files to a folder """
+    def __init__(self, path: Path):
+        self.path = Path(path)
+
+    def write(self, name: str, data: bytes):
+        atomic_write(self.path / name, data)
+
+    def exists(self, name: str) -> bool:
+        return (self.path / name).exists()
+
+    def remove(self, name: str):
+        for path in output_files(self.path / name):
+            path.unlink()
+
+    def link(self, source: str, target: str):
+        link_output(self.path, source, target)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class OutputPackage:
+    """ Outputs written into a VPK, under the materials folder their VMTs point at
+
+    Files go straight into the chunk archives, flush() writes the directory.
+    Only chunks with replaced or removed files are rewritten.
+    """
+    def __init__(self, path: Path, folder: str, version: int, chunk_size: int):
+        self.archive = VPKWriter.VPKArchive(path, version, chunk_size * 2 ** 20)
+        self.folder = folder
+
+    def write(self, name: str, data: bytes):
+        self.archive.write(f"{self.folder}/{name}", data)
+
+    def exists(self, name: str) -> bool:
+        return self.archive.exists(f"{self.folder}/{name}")
+
+    def files(self, name: str) -> list:
+        # Like output_files(): the entry of an output and its exported images
+        stem = f"{self.folder}/{os.path.splitext(name)[0]}"
+        names = [f"{self.folder}/{name}"] + [f"{stem}{mip}.{extension}" for extension in EXPORT_FORMATS
+                                             for mip in ["", *(f"_mip{level}" for level in range(1, 16))]]
+        return [name for name in names if self.archive.exists(name)]
+
+    def remove(self, name: str):
+        for entry in self.files(name):
+            self.archive.remove(entry)
+
+    def link(self, source: str, target: str):
+        source_stem = f"{self.folder}/{os.path.splitext(source)[0]}"
+        target_stem = f"{self.folder}/{os.path.splitext(target)[0]}"
+        for entry in self.files(source):
+            self.archive.link(entry, target_stem + entry[len(source_stem):])
+
+    def flush(self):
+        self.archive.flush()
+
+    def close(self):
+        self.archive.close()
+
+
+class BuildCache:
+    """ On-disk manifest of the outputs in a folder and what they were built from
+
+    Every output records the content hash of its input maps, a hash of the config
+    fields it depends on and the tool version. An output is only rebuilt when one
+    of those changed or the file is gone. Input hashes are reused while the file's
+    size and mtime stay the same, so unchanged libraries don't get re-read.
+    The copies of the profiles, loose files or packaged (targets), are part of
+    the same output. The texture fingerprints of the last build are kept in
+    memory, so watch mode only recomputes those of the materials that changed.
+    """
+    def __init__(self, path: Path, targets: list):
+        self.path = Path(path)
+        self.targets = targets
+        self.files: dict = {}
+        self.outputs: dict = {}
+        # Fingerprint of every texture by material name and texture type value, see fingerprint()
+        self.fingerprints: dict[str, dict] = {}
+        try:
+            with open(self.path) as f:
+                manifest = json.load(f)
+            self.files = manifest.get("files", {})
+            self.outputs = manifest.get("outputs", {})
+        except (OSError, ValueError):
+            pass
+
+    def file_hash(self, path: str) -> str:
+        stat = os.stat(path)
+        key = os.path.abspath(path)
+        entry = self.files.get(key)
+        if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+            return entry["hash"]
+        digest = hashlib.blake2b(digest_size=16)
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        self.files[key] = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "hash": digest.hexdigest()}
+        return digest.hexdigest()
+
+    def image_size(self, path: str) -> tuple:
+        # Size from the header, kept with the hash until the file changes
+        self.file_hash(path)
+        entry = self.files[os.path.abspath(path)]
+        if "image_size" not in entry:
+            entry["image_size"] = list(ImageReaders.probe(path).size)
+        return tuple(entry["image_size"])
+
+    def sources(self) -> dict:
+        # First texture (by material name) of every fingerprint
+        first = {}
+        for name in sorted(self.fingerprints):
+            for type_value, fingerprint in self.fingerprints[name].items():
+                first.setdefault(fingerprint, texture_name(name, TextureType(type_value)))
+        return first
+
+    def settings_hash(self, config: "Config", kind) -> str:
+        settings = {field: str(getattr(config, field)) for field in OUTPUT_SETTINGS[kind]}
+        return hashlib.blake2b(json.dumps(settings, sort_keys=True).encode(), digest_size=16).hexdigest()
+
+    def state(self, config: "Config", kind, inputs: list) -> dict:
+        return {"inputs": {path: self.file_hash(path) for path in inputs if path is not None},
+                "settings": self.settings_hash(config, kind), "version": f"{version}.{OUTPUT_REVISION}"}
+
+    def is_current(self, name: str, state: dict) -> bool:
+        # Outputs shared by reference only need the texture they point to
+        return self.outputs.get(name) == state and all(target.exists(state.get("source", name))
+                                                       for target in self.targets)
+
+    def record(self, name: str, state: dict):
+        self.outputs[name] = state
+
+    def remove_orphans(self, names: set):
+        # Deletes outputs that were built before but whose material is gone
+        for name in list(self.outputs):
+            if name not in names:
+                self.remove(name)
+
+    def remove(self, name: str):
+        logging.info(f"Removing orphaned output '{name}'\n")
+        for target in self.targets:
+            target.remove(name)
+        del self.outputs[name]
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Hashes are kept by absolute path, the states list the inputs as found
+        used = {os.path.abspath(path) for state in self.outputs.values() for path in state["inputs"]}
+        files = {path: entry for path, entry in self.files.items() if path in used}
+        atomic_write(self.path, json.dumps({"version": version, "files": files, "outputs": self.outputs},
+                                           indent=1).encode())
+
+
 def check_new_version():
     # Check for new version from GitHub releases
+    from urllib.request import urlopen
     try:
         response = urlopen("https://api.github.com/repos/hampta/FastValveMaterial/releases/latest")
         data = response.read()
@@ -168,44 +635,532 @@ def check_new_version():
         logging.info(f"Could not check for new version: {e}\n")
  
 
-all_processes = []
+def setup_logging(level: int = logging.INFO):
+    # Console output of the command line tool, importing the module leaves logging alone
+    handler = logging.StreamHandler(sys.stdout)
+    handler.terminator = "\r"
+    logging.basicConfig(format='[FVM] [%(levelname)s] %(message)s', level=level, handlers=[handler])
+
+@lru_cache(maxsize=None)
+def load_vtflib():
+    # Native VTFLib is optional and only loaded once an encoder is picked, VTFWriter is used when it's missing
+    try:
+        import VTFLibWrapper.VTFLib as VTFLib
+    except (ImportError, OSError):
+        return None
+    return VTFLib
 
-handler = logging.StreamHandler(sys.stdout)
-handler.terminator = "\r"
+# VTFLib works on one bound image per process, conversions in other threads wait for it
+VTFLIB_LOCK = threading.Lock()
 
-# /////////////////////
-# Logging setup
-# /////////////////////
-logging.basicConfig(format='[FVM] [%(levelname)s] %(message)s', level=logging.INFO, handlers=[handler])
+def load_watchdog():
+    # Watch mode polls the input folder without watchdog
+    try:
+        from watchdog.observers import Observer
+    except ImportError:
+        return None
+    return Observer
 
 def replace_list(string, list):
     for i in list:
         string = string.replace(i, "")
     return string
 
+# /////////////////////
+# NumPy packing engine
+# /////////////////////
+# These helpers reproduce Pillow's integer math bit for bit, so the numpy
+# engine writes the same bytes as the Pillow blend/split/merge chains.
+
+def open_image(source) -> Image.Image:
+    # A map from a path, or one handed over in memory: encoded file bytes, an image or a uint8 array
+    if isinstance(source, Image.Image):
+        return source
+    if isinstance(source, np.ndarray):
+        return Image.fromarray(source)
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return Image.open(BytesIO(source))
+    return Image.open(source)
+
+def image_mode(image) -> str:
+    # Routed channels and bands of the fast path readers are already arrays
+    if isinstance(image, np.ndarray):
+        return "L" if image.ndim == 2 else "RGB" if image.shape[2] == 3 else "RGBA"
+    return image.mode
+
+def as_array(image: Image.Image, mode: str) -> np.ndarray:
+    # Decode an image once into a uint8 array of the requested mode, arrays are converted like PIL does
+    if isinstance(image, np.ndarray):
+        return convert_array(image, mode)
+    if image.mode != mode:
+        image = image.convert(mode)
+    return np.asarray(image)
+
+def convert_array(array: np.ndarray, mode: str) -> np.ndarray:
+    # L, RGB and RGBA conversions of Image.convert, the alpha is dropped or opaque
+    current = image_mode(array)
+    if current == mode:
+        return array
+    if mode == "L":
+        return luma(array)
+    if current == "L":
+        array = array[..., None].repeat(3, 2)
+    if mode == "RGB":
+        return array[..., :3]
+    out = np.empty(array.shape[:2] + (4,), np.uint8)
+    out[..., :3] = array
+    out[..., 3] = 255
+    return out
+
+def muldiv255(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    # ImageChops.multiply: a * b // 255, using the shift form of the division
+    tmp = np.multiply(a, b, dtype=np.uint16)
+    tmp += (tmp >> 8) + 1
+    tmp >>= 8
+    return tmp.astype(np.uint8)
+
+def blend(a, b: np.ndarray, alpha: float, out: np.ndarray = None) -> np.ndarray:
+    # Image.blend: a + alpha * (b - a) in single precision, truncated
+    tmp = np.subtract(b, a, dtype=np.float32)
+    tmp *= np.float32(alpha)
+    tmp += np.float32(a) if np.isscalar(a) else a
+    if out is None:
+        return tmp.astype(np.uint8)
+    np.copyto(out, tmp, casting="unsafe")
+    return out
+
+def luma(rgb: np.ndarray) -> np.ndarray:
+    # RGB -> L conversion (ITU-R 601-2) with Pillow's fixed point weights
+    tmp = np.multiply(rgb[..., 0], 19595, dtype=np.uint32)
+    tmp += np.multiply(rgb[..., 1], 38470, dtype=np.uint32)
+    tmp += np.multiply(rgb[..., 2], 7471, dtype=np.uint32)
+    tmp += 0x8000
+    tmp >>= 16
+    return tmp.astype(np.uint8)
+
+EXPONENT_LAYER = (0, 217, 0, 100)
+EXPONENT_GREEN = int(luma(np.array(EXPONENT_LAYER[:3], np.uint8)))
+
+# /////////////////////
+# Channel transforms
+# /////////////////////
+
+@lru_cache(maxsize=None)
+def gamma_exponent(midtone: int) -> float:
+    # Levels midtone (0-255) -> power applied to the normalized values, None for 128 (no change)
+    midtone_normal = midtone / 255
+    if midtone < 128:
+        gamma = min(1 + (9 * (1 - midtone_normal * 2)), 9.99)
+    elif midtone > 128:
+        gamma = max(1 - (midtone_normal * 2 - 1), 0.01)
+    else:
+        return None
+    return 1 / gamma
+
+@lru_cache(maxsize=None)
+def channel_lut(invert: bool = False, midtone: int = 128, blend_value: int = None, blend_alpha: float = 0.0):
+    """ One 256 entry table for a chain of per-channel steps, in this order:
+    invert -> levels midtone -> blend from a constant value by blend_alpha
+
+    Every step rounds like its Pillow counterpart, so lut[image] matches running
+    them one after another. Tables are cached and read-only.
+    """
+    lut = np.arange(256, dtype=np.uint8)
+    if invert:
+        lut = 255 - lut
+    exponent = gamma_exponent(midtone)
+    if exponent is not None:
+        lut = np.array([round(((x / 255) ** exponent) * 255) for x in lut], np.uint8)
+    if blend_value is not None:
+        lut = blend(blend_value, lut, blend_alpha)
+    lut.flags.writeable = False
+    return lut
+
+def metallic_lut(metallic_factor: int) -> np.ndarray:
+    # Diffuse alpha from the metallic map, blended from white by the metallic factor
+    return channel_lut(blend_value=255, blend_alpha=metallic_factor / 255 * 0.83)
+
+def channels(image: np.ndarray, count: int) -> np.ndarray:
+    # View of the first channels of an L, RGB or RGBA array, L broadcasts
+    return image[..., None] if image.ndim == 2 else image[..., :count]
+
+def pack_diffuse(color: np.ndarray, ao: np.ndarray, metallic: np.ndarray, gloss: np.ndarray,
+                 alpha_lut: np.ndarray) -> np.ndarray:
+    # color: RGB, ao, gloss: L or RGB, metallic: L, alpha_lut: see metallic_lut(). Returns the RGBA _c texture
+    out = np.empty(metallic.shape + (4,), np.uint8)
+    if ao is None:
+        blend(color, muldiv255(color, channels(gloss, 3)), 0.3, out=out[..., :3])
+    else:
+        out[..., :3] = muldiv255(color, channels(ao, 3))
+    np.take(alpha_lut, metallic, out=out[..., 3])
+    return out
+
+def pack_exponent(gloss: np.ndarray, clear_exponent: bool) -> np.ndarray:
+    # gloss: L, RGB or RGBA. Returns the RGBA _m texture
+    out = np.empty(gloss.shape[:2] + (4,), np.uint8)
+    out[..., 0] = gloss if gloss.ndim == 2 else gloss[..., 0]
+    out[..., 1] = 255 if clear_exponent else EXPONENT_GREEN
+    out[..., 2] = 0
+    out[..., 3] = gloss[..., 3] if gloss.ndim == 3 and gloss.shape[2] == 4 else 255
+    return out
+
+def pack_normal(normal: np.ndarray, gloss: np.ndarray) -> np.ndarray:
+    # normal: RGB or RGBA, gloss: gamma corrected L. Returns the RGBA _n texture with gloss in alpha
+    out = np.empty(normal.shape[:2] + (4,), np.uint8)
+    out[..., :3] = normal[..., :3]
+    out[..., 3] = gloss
+    return out
+
+def storage_mode(mode: str) -> str:
+    # Smallest array layout that holds an image of this mode without losing anything
+    if mode in ("1", "L", "I", "I;16", "F"):
+        return "L"
+    return "RGB" if mode in ("RGB", "YCbCr", "HSV") else "RGBA"
+
+if sys.platform == "win32":
+    class ProcessMemoryCounters(ctypes.Structure):
+        _fields_ = [("cb", ctypes.c_ulong), ("PageFaultCount", ctypes.c_ulong),
+                    ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                    ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                    ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                    ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+
+def peak_rss() -> int:
+    # Peak resident memory of this process in bytes since the last reset_peak_rss(), 0 where it can't be read
+    if sys.platform == "win32":
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return counters.PeakWorkingSetSize
+        return 0
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    if resource is None:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+def reset_peak_rss():
+    # Only Linux can reset the peak (to the current resident memory), elsewhere it's the peak since the start
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+class Profiler:
+    """ Wall time, CPU time, bytes read and written and peak memory per pipeline stage
+
+    Stages can be nested, the time of an inner stage isn't counted in the outer
+    one, so the totals add up to the time spent inside all stages. CPU time is
+    the time of the calling thread. Peak memory is the high-water mark of the
+    process, reset at every stage boundary where the OS allows it, so stages
+    running at the same time in other threads share it. With trace on, every
+    stage is also kept as an event for the JSON-lines/Chrome export.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self, trace: bool = False):
+        self.stages: dict[str, dict] = {}
+        self.events = [] if trace else None
+        self._stack = []
+
+    def totals(self, name: str) -> dict:
+        if name not in self.stages:
+            self.stages[name] = {"wall": 0.0, "cpu": 0.0, "read": 0, "written": 0, "peak_rss": 0}
+        return self.stages[name]
+
+    @contextmanager
+    def stage(self, name: str):
+        wall, cpu = time.perf_counter(), time.thread_time()
+        if self._stack:
+            self._pause(self._stack[-1], wall, cpu)
+            self._sample_peak(self._stack[-1][0])
+        reset_peak_rss()
+        self._stack.append([name, wall, cpu])
+        start = time.time()
+        try:
+            yield
+        finally:
+            end_wall, end_cpu = time.perf_counter(), time.thread_time()
+            self._pause(self._stack.pop(), end_wall, end_cpu)
+            self._sample_peak(name)
+            reset_peak_rss()
+            if self._stack:
+                self._stack[-1][1:] = [end_wall, end_cpu]
+            if self.events is not None:
+                self.events.append({"stage": name, "start": start, "duration": end_wall - wall, "pid": os.getpid()})
+
+    def _pause(self, entry: list, wall: float, cpu: float):
+        totals = self.totals(entry[0])
+        totals["wall"] += wall - entry[1]
+        totals["cpu"] += cpu - entry[2]
+
+    def _sample_peak(self, name: str):
+        totals = self.totals(name)
+        totals["peak_rss"] = max(totals["peak_rss"], peak_rss())
+
+    def count(self, read: int = 0, written: int = 0):
+        # Bytes moved by the innermost running stage
+        totals = self.totals(self._stack[-1][0] if self._stack else "other")
+        totals["read"] += read
+        totals["written"] += written
+
+    def snapshot(self) -> dict:
+        return {"stages": self.stages, "events": self.events}
+
+    def merge(self, stages: dict):
+        for name, values in stages.items():
+            totals = self.totals(name)
+            for key, value in values.items():
+                totals[key] = max(totals[key], value) if key == "peak_rss" else totals[key] + value
+
+class LocalProfiler(Profiler, threading.local):
+    """ A Profiler per thread, conversions running in parallel threads keep their stages apart """
+
+# Stages of the thread this runs in, sent back to the main process with every task result
+profiler = LocalProfiler()
+
+
+class Progress:
+    """ Textures done so far, the time it took and an estimate of the time left """
+    def __init__(self, total: int):
+        self.total = total
+        self.done = 0
+        self.start = time.perf_counter()
+
+    def update(self) -> str:
+        self.done += 1
+        elapsed = time.perf_counter() - self.start
+        left = elapsed / self.done * (self.total - self.done)
+        return (f"[{self.done}/{self.total} {self.done / max(self.total, 1):.0%}] "
+                f"{format_duration(elapsed)} elapsed, ETA {format_duration(left)}")
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02}:{seconds:02}" if hours else f"{minutes}:{seconds:02}"
+
+
+class TraceWriter:
+    """ Writes profiler events as they come in, as JSON lines or a Chrome trace (chrome://tracing, Perfetto)
+
+    The Chrome trace array is only closed at the end, the viewers also load it
+    without the closing bracket if the run is interrupted.
+    """
+    def __init__(self, path: Path):
+        self.chrome = path.suffix.lower() != ".jsonl"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(path, "w")
+        if self.chrome:
+            self.file.write("[\n")
+
+    def write(self, events: list, material: str, texture: str):
+        for event in events:
+            if self.chrome:
+                record = {"name": event["stage"], "cat": texture, "ph": "X", "ts": event["start"] * 1e6,
+                          "dur": event["duration"] * 1e6, "pid": event["pid"], "tid": 0,
+                          "args": {"material": material, "texture": texture}}
+                self.file.write(json.dumps(record) + ",\n")
+            else:
+                self.file.write(json.dumps({"material": material, "texture": texture, **event}) + "\n")
+        self.file.flush()
+
+    def close(self):
+        if self.chrome:
+            # A trailing comma isn't valid JSON, close with a metadata event
+            self.file.write(json.dumps({"name": "process_name", "ph": "M", "pid": os.getpid(),
+                                        "args": {"name": "FastValveMaterial"}}) + "\n]\n")
+        self.file.close()
+
+
+class MapSource:
+    """ A source map read in horizontal bands at the output size """
+    def __init__(self, image: Image.Image, size: tuple):
+        self.image = image
+        self.size = size
+
+    def has_alpha(self) -> bool:
+        return "A" in self.image.getbands() or "transparency" in self.image.info
+
+    def rows(self, top: int, bottom: int) -> Image.Image:
+        width, height = self.size
+        with profiler.stage("decode"):
+            if self.image.im is None and getattr(self.image, "filename", None):
+                profiler.count(read=os.path.getsize(self.image.filename))
+            self.image.load()
+            if self.image.size == self.size:
+                return self.image.crop((0, top, width, bottom))
+        # Only the band is resampled, the filter still reads the source rows around it
+        scale = self.image.height / height
+        with profiler.stage("scale"):
+            return self.image.resize((width, bottom - top), Image.Resampling.LANCZOS,
+                                     box=(0, top * scale, self.image.width, bottom * scale))
+
+
+class ReaderSource:
+    """ A source map at the output size read through ImageReaders, bands are arrays without PIL """
+    def __init__(self, reader: ImageReaders.ImageReader):
+        self.reader = reader
+
+    def has_alpha(self) -> bool:
+        return "A" in self.reader.mode
+
+    def rows(self, top: int, bottom: int) -> np.ndarray:
+        with profiler.stage("decode"):
+            band = self.reader.rows(top, bottom)
+            profiler.count(read=band.nbytes)
+            return band
+
+
+class ConstantSource:
+    """ Stand-in for a missing map """
+    def __init__(self, mode: str, size: tuple, color: tuple):
+        self.mode = mode
+        self.size = size
+        self.color = color
+
+    def rows(self, top: int, bottom: int) -> Image.Image:
+        return Image.new(self.mode, (self.size[0], bottom - top), self.color)
+
+
+class PackedSource:
+    """ A map that holds several routed channels, decoded once per band for all of them """
+    def __init__(self, source, mode: str):
+        self.source = source
+        self.mode = mode
+        self.band = None
+        self.array = None
+
+    def rows(self, top: int, bottom: int) -> np.ndarray:
+        if self.band != (top, bottom):
+            self.array = as_array(self.source.rows(top, bottom), self.mode)
+            self.band = (top, bottom)
+        return self.array
+
+
+class ChannelSource:
+    """ One channel of a packed map, a view into the decoded band without a copy """
+    def __init__(self, source: PackedSource, channel: int):
+        self.source = source
+        self.channel = channel
+
+    def rows(self, top: int, bottom: int) -> np.ndarray:
+        return self.source.rows(top, bottom)[..., self.channel]
+
+
+class MaterialCache:
+    """ Decoded maps of one material, shared with the workers as memory-mapped .npy files
+
+    Written once by decode_material and only read afterwards. evict() removes it
+    once every texture of the material is written. Without a path the maps are
+    plain arrays that stay in memory, for conversions within one process.
+    """
+    def __init__(self, path: str, size: tuple):
+        self.path = path
+        self.size = size
+        self.maps: dict = {}
+        # Maps that are a single color so far, and that color
+        self.uniform: dict = {}
+        self._arrays: dict = {}
+        self._first: dict = {}
+
+    def create(self, role: str, band: np.ndarray) -> np.ndarray:
+        if role not in self._arrays:
+            self.maps[role] = f"{role}.npy"
+            shape = (self.size[1],) + band.shape[1:]
+            if self.path is None:
+                self._arrays[role] = np.empty(shape, band.dtype)
+                return self._arrays[role]
+            self._arrays[role] = np.lib.format.open_memmap(os.path.join(self.path, self.maps[role]),
+                                                           mode="w+", dtype=band.dtype, shape=shape)
+        return self._arrays[role]
+
+    def check_uniform(self, role: str, band: np.ndarray):
+        first = self._first.setdefault(role, band[0, 0].copy())
+        self.uniform[role] = self.uniform.get(role, True) and bool((band == first).all())
+
+    def close(self) -> "MaterialCache":
+        if self.path is None:
+            return self
+        for array in self._arrays.values():
+            array.flush()
+        self._arrays = {}
+        return self
+
+    def open(self, role: str) -> np.ndarray:
+        if self.path is None:
+            return self._arrays[role]
+        return np.load(os.path.join(self.path, self.maps[role]), mmap_mode="r")
+
+    def evict(self):
+        self._arrays = {}
+        if self.path is not None:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+    def __getstate__(self):
+        # Only the location is sent to other processes
+        return {"path": self.path, "size": self.size, "maps": self.maps, "uniform": self.uniform,
+                "_arrays": {}, "_first": {}}
+
+
 class FastValveMaterial:
-    def __init__(self, config: Config, args: argparse.Namespace):
+    def __init__(self, config: Config, args: argparse.Namespace = None):
         self.config: Config = config
+        # Kept between runs in watch mode, created per run otherwise
+        self.pool: ProcessPoolExecutor = None
+        self.cache: BuildCache = None
+        self.targets: dict = None
+        # Input files by material and map role, see index_path()
+        self.index: dict[str, dict] = {}
         if self.config.debug_messages:
             logging.getLogger().setLevel(logging.DEBUG)
-        self.all_processes: list = []
-        self.vtf_lib = VTFLib.VTFLib()
-        self.vtf_lib.create_default_params_structure()
+        if self.config.encoder == "auto":
+            self.config.encoder = "vtflib" if load_vtflib() is not None else "python"
+        if self.config.encoder == "vtflib":
+            if load_vtflib() is None:
+                raise RuntimeError("Encoder is set to 'vtflib' but VTFLibWrapper could not be loaded")
+            self.vtf_lib = load_vtflib().VTFLib()
+            self.vtf_lib.create_default_params_structure()
+        if args is None:
+            return
         if args.input:
-            config.input_path = Path(args.input)
+            self.config.input_path = Path(args.input)
         if args.output:
-            config.output_path = Path(args.output)
+            self.config.output_path = Path(args.output)
+        if args.package:
+            self.config.package_path = Path(args.package)
         if args.threads:
-            config.thread_count = int(args.threads)
+            self.config.thread_count = int(args.threads)
         if args.debug:
-            config.debug_messages = True
+            self.config.debug_messages = True
         if args.fast_export:
-            config.fast_export = True
+            self.config.fast_export = True
         if args.export:
-            config.export_images = True
+            self.config.export_images = True
+        if args.force:
+            self.config.force_rebuild = True
+        if args.profile:
+            self.config.profile_path = Path(args.profile)
+        self.config.validate()
         
-    def do_diffuse(self, color_image: Image.Image, ao_image: Image.Image,
-               metallic_image: Image.Image, glossiness_image: Image.Image, material_name: str):
+    def do_diffuse(self, color_image: np.ndarray, ao_image: np.ndarray,
+               metallic_image: np.ndarray, glossiness_image: np.ndarray) -> np.ndarray:
+        if self.config.packing_engine == "numpy":
+            return pack_diffuse(color_image, ao_image, metallic_image, glossiness_image,
+                                metallic_lut(self.config.metallic_factor))
+        color_image = Image.fromarray(color_image)
+        metallic_image = Image.fromarray(metallic_image)
+        glossiness_image = Image.fromarray(glossiness_image)
+        if ao_image is not None:
+            ao_image = Image.fromarray(ao_image)
         final_diffuse = color_image.convert("RGBA")
         if ao_image is None:
             final_diffuse = ImageChops.blend(final_diffuse.convert("RGB"),
@@ -219,15 +1174,16 @@ class FastValveMaterial:
                         self.config.metallic_factor / 255 * 0.83).convert("L")
         color_spc = (r, g, b, a)
         final_diffuse = Image.merge("RGBA", color_spc)
-        logging.info(f"Exporting {material_name}_c...\n")
-        self.export_texture(final_diffuse, material_name, TextureType.DIFFUSE, 'DXT5')
+        return np.asarray(final_diffuse)
         
-    def do_exponent(self, glossiness_image: Image.Image, material_name: str):
-        final_exponent = glossiness_image.convert("RGBA")
+    def do_exponent(self, glossiness_image: np.ndarray) -> np.ndarray:
+        if self.config.packing_engine == "numpy":
+            return pack_exponent(glossiness_image, self.config.clear_exponent)
+        final_exponent = Image.fromarray(glossiness_image).convert("RGBA")
         r, g, b, a = final_exponent.split()
         layerImage = Image.new('RGBA',
                                [final_exponent.size[0], final_exponent.size[1]],
-                               (0, 217, 0, 100))
+                               EXPONENT_LAYER)
         blackImage = Image.new('RGBA',
                                [final_exponent.size[0], final_exponent.size[1]],
                                (0, 0, 0, 100))
@@ -240,217 +1196,980 @@ class FastValveMaterial:
             g = Image.new('L', [final_exponent.size[0], final_exponent.size[1]], 255)
         colorSpc = (r, g, b, a)
         final_exponent = Image.merge('RGBA', colorSpc)
-        logging.info(f"Exporting {material_name}_m...\n")
-        self.export_texture(final_exponent, material_name,
-                            TextureType.EXPONENT, 'DXT5' if self.config.force_compression else 'DXT1')
+        return np.asarray(final_exponent)
         
-    def do_normal(self, normalmap_image: Image.Image, glossiness_image: Image.Image, material_name: str):
-        final_normal = normalmap_image.convert('RGBA')
-        final_gloss = glossiness_image.convert('RGBA')
-        final_gloss = self.do_gamma(final_gloss, self.config.midtone)
+    def do_normal(self, normalmap_image: np.ndarray, gloss_gamma: np.ndarray) -> np.ndarray:
+        # gloss_gamma: the gamma corrected gloss from gloss_gamma()
+        if self.config.packing_engine == "numpy":
+            return pack_normal(normalmap_image, gloss_gamma)
+        final_normal = Image.fromarray(normalmap_image).convert('RGBA')
         r, g, b, a = final_normal.split()
-        a = Image.blend(a, final_gloss.convert('L'), 1).convert('L')
+        a = Image.blend(a, Image.fromarray(gloss_gamma), 1).convert('L')
         colorSpc = (r, g, b, a)
         final_normal = Image.merge('RGBA', colorSpc)
-        logging.info(f"Exporting {material_name}_n...\n")
-        self.export_texture(final_normal, material_name,
-                            TextureType.NORMAL, 'DXT5' if self.config.force_compression else 'RGBA8888')
+        return np.asarray(final_normal)
+
+    def gloss_gamma(self, glossiness_image: np.ndarray, invert: bool) -> np.ndarray:
+        # Gloss as it ends up in the alpha channel of the normal map, from the gloss
+        # (or roughness, invert = True) as read
+        if self.config.packing_engine == "numpy":
+            gloss_lut = channel_lut(invert, self.config.midtone)
+            glossiness_image = gloss_lut[glossiness_image if glossiness_image.ndim == 2 else glossiness_image[..., :3]]
+            # luma() of a gray pixel is the pixel itself
+            return luma(glossiness_image) if glossiness_image.ndim == 3 else glossiness_image
+        final_gloss = Image.fromarray(glossiness_image)
+        if invert:
+            final_gloss = ImageOps.invert(final_gloss)
+        final_gloss = self.do_gamma(final_gloss.convert('RGBA'), self.config.midtone)
+        return np.asarray(final_gloss.convert('L'))
         
     def do_gamma(self, image: Image.Image, gamma: float):
-        gamma = 1
-        midToneNormal = gamma / 255
-        if gamma < 128:
-            midToneNormal = midToneNormal * 2
-            gamma = 1 + (9 * (1 - midToneNormal))
-            gamma = min(gamma, 9.99)
-        elif gamma > 128:
-            midToneNormal = (midToneNormal * 2) - 1
-            gamma = 1 - midToneNormal
-            gamma = max(gamma, 0.01)
-        gamma_correction = 1 / gamma
-        if gamma != 128:
-            return image.point(lambda x: ((x/255)**gamma_correction)*255)
+        if gamma_exponent(gamma) is not None:
+            return image.point(channel_lut(midtone=gamma).tolist() * len(image.getbands()))
         return image
     
-    def fix_scale_mismatch(self, image: Image.Image, target: Image.Image, skip_factor=False):
-        if self.config.input_scale != 1.0:
-            target = target.resize((int(target.width * self.config.input_scale),
-                                    int(target.height * self.config.input_scale)),
-                                    Image.Resampling.LANCZOS)
-        if skip_factor:
-            return target
-        factor = image.width / target.width
-        return ImageOps.scale(target, factor, Image.Resampling.LANCZOS)
+    def fix_scale_mismatch(self, image: Image.Image, size: tuple) -> MapSource:
+        # Every map is resampled straight to the output size, band by band
+        return MapSource(image, size)
+
+    def open_source(self, source, size: tuple):
+        # Uncompressed TGA/DDS and BC1/BC3 DDS files at the output size skip PIL, the rest is decoded by it
+        if isinstance(source, (str, os.PathLike)):
+            reader = ImageReaders.open_reader(source)
+            if reader is not None and reader.size == size:
+                return ReaderSource(reader)
+        return self.fix_scale_mismatch(open_image(source), size)
+
+    def output_size(self, material: Material, cache: "BuildCache" = None) -> tuple:
+        # The normal map (the color map in ORM mode) sets the size of all outputs, read from its header
+        reference = material.color_path if self.config.orm else material.normal_path
+        if cache is not None and isinstance(reference, (str, os.PathLike)):
+            width, height = cache.image_size(reference)
+        elif isinstance(reference, (str, os.PathLike)):
+            width, height = ImageReaders.probe(reference).size
+        else:
+            width, height = open_image(reference).size
+        size = (max(int(width * self.config.input_scale), 1), max(int(height * self.config.input_scale), 1))
+        if self.config.encoder == "python":
+            # VTF needs power of two sides, VTFLib does this itself with its Resize option
+            size = (VTFWriter.nearest_power_of_two(size[0]), VTFWriter.nearest_power_of_two(size[1]))
+        return size
+
+    def band_rows(self, width: int, height: int) -> int:
+        # Rows converted at once so a band stays within MaxMemory
+        if self.config.max_memory <= 0:
+            return height
+        rows = self.config.max_memory * 2 ** 20 // (width * BAND_BYTES_PER_PIXEL) // 4 * 4
+        return max(4, min(height, rows))
     
-    def do_material(self, material_name: str):
+    def do_material(self, material_name: str, targets: dict, textures: dict = None):
         logging.debug(f"Creating material '{material_name}'\n")
-        if "materials" in self.config.output_path.parts:
-            texture_local_path = "/".join(self.config.output_path.parts[self.config.output_path.parts.index("materials") + 1:])
+        # Every profile gets its own VMT, pointing at the textures in its folder
+        for profile, output_path in self.output_paths().items():
+            data = self.material_vmt(material_name, textures, output_path).encode()
+            targets[profile].write(f"{material_name}.vmt", data)
+            profiler.count(written=len(data))
+            if self.config.phongwarps and not self.config.clear_exponent:
+                targets[profile].write("phongwarp_steel.vtf", phongwarp_data())
+        logging.debug("Material exported\n")
+
+    def output_paths(self) -> dict:
+        # Output folder by profile name, None is the full size output
+        return {None: self.config.output_path,
+                **{profile.name: profile.path or Path(f"{self.config.output_path}_{profile.name}")
+                   for profile in self.config.profiles}}
+
+    def open_outputs(self) -> dict:
+        # Where the outputs of every profile go: loose files in its folder, or one VPK per profile
+        # (pak01_dir.vpk, pak01_half_dir.vpk, ...) with the files where the VMTs look for them
+        targets = {}
+        for profile, output_path in self.output_paths().items():
+            if self.config.package_path is None:
+                targets[profile] = OutputFolder(output_path)
+                continue
+            path = self.config.package_path
+            if profile is not None:
+                path = path.with_name(path.name.replace("_dir.vpk", f"_{profile}_dir.vpk"))
+            targets[profile] = OutputPackage(path, f"materials/{self.material_folder(output_path)}",
+                                             self.config.package_version, self.config.package_chunk_size)
+        return targets
+
+    def manifest_path(self) -> Path:
+        # Next to the directory file when packaging, in the output folder otherwise
+        if self.config.package_path is not None:
+            return self.config.package_path.with_name(f".{self.config.package_path.stem}{MANIFEST_NAME}")
+        return self.config.output_path / MANIFEST_NAME
+
+    def material_folder(self, output_path: Path) -> str:
+        # Folder of the textures relative to materials/, as the VMTs reference it
+        if "materials" in output_path.parts:
+            return "/".join(output_path.parts[output_path.parts.index("materials") + 1:])
+        return output_path.as_posix().lstrip("/")
+
+    def material_vmt(self, material_name: str, textures: dict = None, output_path: Path = None) -> str:
+        # textures: texture name (without .vtf) by type value, where another material's texture is used
+        textures = {**{texture_type.value: f"{material_name}_{texture_type.value}" for texture_type in TextureType},
+                    **(textures or {})}
+        output_path = output_path or self.config.output_path
+        if "materials" in output_path.parts:
+            texture_local_path = self.material_folder(output_path)
         else:
-            texture_local_path = self.config.output_path
+            texture_local_path = output_path
         if self.config.clear_exponent:
             writer = VMT_NORMAL_TEMPLATE.format(
                 version=version, config=self.config,
                 output_path=texture_local_path,
-                material_name=material_name,
+                material_name=material_name, textures=textures,
                 proxies=PROXIES_TEMPLATE if self.config.material_proxies else "")
         else:
             writer = VMT_TEMPLATE.format(
                 version=version, config=self.config,
                 output_path=texture_local_path,
-                material_name=material_name,
+                material_name=material_name, textures=textures,
                 metallic_factor=self.config.metallic_factor,
                 midtone=self.config.midtone, 
                 phong=f'"$phongwarptexture" "{texture_local_path}/phongwarp_steel"' if self.config.phongwarps else '"$PhongFresnelRanges" "[ 4 3 10 ]"',
                 proxies=PROXIES_TEMPLATE if self.config.material_proxies else "")
-        Path(self.config.output_path).mkdir(parents=True, exist_ok=True)
-        with open(os.path.join(self.config.output_path, f"{material_name}.vmt"), "w") as f:
-            f.writelines(writer)
-        if self.config.phongwarps and not self.config.clear_exponent:
-            shutil.copy(os.path.join(os.path.dirname(__file__), "phongwarp_steel.vtf"), self.config.output_path)
-        logging.debug("Material exported\n")
+        return writer
         
-    def export_texture(self, texture: Image.Image, material_name: str, texture_type: TextureType, imageFormat=None):
-        image_name = f'{material_name}_{texture_type.value}.vtf'
-        output_path = Path(f'{self.config.output_path}\\{image_name}')
-        def_options = self.vtf_lib.create_default_params_structure()
+    def texture_format(self, imageFormat: str):
+        flags = ImageFlag.NONE
         if imageFormat.startswith('RGBA8888') or self.config.fast_export:
-            def_options.ImageFormat = VTFLibEnums.ImageFormat.ImageFormatRGBA8888
-            def_options.Flags |= VTFLibEnums.ImageFlag.ImageFlagEightBitAlpha
+            image_format = ImageFormat.RGBA8888
+            flags |= ImageFlag.EIGHTBITALPHA
             if imageFormat == 'RGBA8888Normal':
-                def_options.Flags |= VTFLibEnums.ImageFlag.ImageFlagNormal
+                flags |= ImageFlag.NORMAL
         elif imageFormat.startswith('DXT1'):
-            def_options.ImageFormat = VTFLibEnums.ImageFormat.ImageFormatDXT1
+            image_format = ImageFormat.DXT1
             if imageFormat == 'DXT1Normal':
-                def_options.Flags |= VTFLibEnums.ImageFlag.ImageFlagNormal
+                flags |= ImageFlag.NORMAL
         elif imageFormat.startswith('DXT5'):
-            def_options.ImageFormat = VTFLibEnums.ImageFormat.ImageFormatDXT5
-            def_options.Flags |= VTFLibEnums.ImageFlag.ImageFlagEightBitAlpha
+            image_format = ImageFormat.DXT5
+            flags |= ImageFlag.EIGHTBITALPHA
             if imageFormat == 'DXT5Normal':
-                def_options.Flags |= VTFLibEnums.ImageFlag.ImageFlagNormal
+                flags |= ImageFlag.NORMAL
         else:
-            def_options.ImageFormat = VTFLibEnums.ImageFormat.ImageFormatRGBA8888
-            def_options.Flags |= VTFLibEnums.ImageFlag.ImageFlagEightBitAlpha
+            image_format = ImageFormat.RGBA8888
+            flags |= ImageFlag.EIGHTBITALPHA
+        return image_format, flags
+
+    def export_texture(self, bands, size: tuple, material_name: str, texture_type: TextureType, imageFormat=None) -> list:
+        # bands: RGBA row bands of the texture, top to bottom
+        # Returns the encoded files as (profile name, path in its output folder, bytes), they're
+        # written by the main process while this worker moves on to the next texture
+        image_name = texture_name(material_name, texture_type)
+        image_format, flags = self.texture_format(imageFormat)
+        mipmap_options = (self.config.mip_filter, self.config.normalize_mipmaps and texture_type == TextureType.NORMAL,
+                          self.config.alpha_coverage)
+        # Profiles are the same mip chain from a lower level on, None is the full size texture
+        count = VTFWriter.mipmap_count(*size)
+        first_levels = {None: 0, **{profile.name: min(profile.first_level(size), count - 1)
+                                    for profile in self.config.profiles}}
+        # Mip levels the image export needs, taken from the same chain the VTF is built from
+        exported = 0
+        if self.config.export_images:
+            exported = count if self.config.export_mipmaps else 1
+        wanted = {first + level for first in first_levels.values() for level in range(exported) if first + level < count}
+        levels = {}
+
+        def keep_level(level: int, rows: np.ndarray):
+            if level in wanted:
+                levels.setdefault(level, []).append(rows)
+
+        if self.config.encoder == "python":
+            stream = VTFWriter.VTFStream(*size, image_format, flags, self.config.compression_quality,
+                                         *mipmap_options, on_level=keep_level)
+            for band in bands:
+                # Same as stream.write(), split up so mipmaps and compression are timed separately
+                with profiler.stage("mipmaps"):
+                    mipmaps = stream.chain.write(band)
+                with profiler.stage("compression"):
+                    for level, rows in mipmaps:
+                        keep_level(level, rows)
+                        stream.encode(rows, level)
+            with profiler.stage("compression"):
+                outputs = [(profile, image_name, stream.getvalue(first)) for profile, first in first_levels.items()]
+            images = {level: np.concatenate(rows) for level, rows in levels.items()}
+        else:
+            # VTFLib needs the whole image and builds its own mipmaps, for the profiles from their first level
+            texture = np.concatenate(list(bands))
+            wanted.update(first_levels.values())
+            if wanted != {0}:
+                with profiler.stage("mipmaps"):
+                    for level, rows in VTFWriter.MipChain(*size, *mipmap_options).write(texture):
+                        keep_level(level, rows)
+            else:
+                keep_level(0, texture)
+            images = {level: np.concatenate(rows) for level, rows in levels.items()}
+            with profiler.stage("compression"):
+                outputs = [(profile, image_name, self.export_texture_vtflib(Image.fromarray(images[first], "RGBA"),
+                                                                              image_format, flags))
+                           for profile, first in first_levels.items()]
+        logging.debug(f"{texture_type.name} encoded\n")
 
+        with profiler.stage("encode"):
+            for profile, first in first_levels.items():
+                for level in range(first, min(first + exported, count)):
+                    outputs.append((profile, *self.export_image(images[level], image_name, level - first)))
+        return outputs
+
+    def export_image(self, image: np.ndarray, image_name: str, level: int = 0) -> tuple:
+        stem = image_name[:-len(".vtf")] + (f"_mip{level}" if level else "")
+        buffer = BytesIO()
+        Image.fromarray(image, "RGBA").save(buffer, self.config.export_format.upper())
+        logging.debug(f"Encoded {stem} as {self.config.export_format.upper()}\n")
+        return f"{stem}.{self.config.export_format}", buffer.getvalue()
+
+    def export_texture_vtflib(self, texture: Image.Image, image_format: ImageFormat, flags: ImageFlag) -> bytes:
+        # VTFLib can only save to a file path, the file is read back so the VTF is
+        # written like the python encoder's
+        def_options = self.vtf_lib.create_default_params_structure()
+        def_options.ImageFormat = image_format
+        def_options.Flags |= flags
         def_options.Resize = 1
         w, h = texture.size
         image_data = create_string_buffer(texture.tobytes())
-        self.vtf_lib.image_create_single(w, h, image_data, def_options)
-        self.vtf_lib.image_save(image_name)
-        self.vtf_lib.image_destroy()
-
-        if os.path.exists(output_path):
-            logging.debug(f"{texture_type.name} already exists, replacing!\n")
-            src = os.path.join(os.getcwd(), image_name)
-            dst = os.path.join(os.getcwd(), output_path)
-            shutil.copyfile(src, dst, follow_symlinks=True)
-            os.remove(os.path.join(os.getcwd(), image_name))
-        else:
-            Path(self.config.output_path).mkdir(parents=True, exist_ok=True)
-            shutil.move(image_name, os.path.join(os.getcwd(), self.config.output_path))
-            logging.debug(f"{texture_type.name} exported\n")
+        fd, tmp_path = tempfile.mkstemp(prefix="fvm-", suffix=".vtf", dir=self.config.cache_path)
+        os.close(fd)
+        try:
+            with VTFLIB_LOCK:
+                self.vtf_lib.image_create_single(w, h, image_data, def_options)
+                try:
+                    self.vtf_lib.image_save(tmp_path)
+                finally:
+                    self.vtf_lib.image_destroy()
+            with open(tmp_path, "rb") as f:
+                data = f.read()
+        finally:
+            os.remove(tmp_path)
+        if not data:
+            raise OSError("VTFLib could not save the texture")
+        return data
 
-        path = image_name.replace(".vtf", ".tga")
+    def open_maps(self, material: Material, texture_types: list, size: tuple) -> dict:
+        # Files are opened from their header, pixels are decoded once the first band is read.
+        # Every file is opened once, also when several maps or channels come from it
+        sources = {}
+        maps = set().union(*(TEXTURE_MAPS[t] for t in texture_types))
+        files = self.source_paths(material)
+        opened = {}
 
-        if self.config.export_images:
-            texture.save(os.path.join(self.config.output_path, path))
-            logging.debug(f"Exported {path} as TGA\n")
-        
-    def convert_material(self, material: Material):
-        processes = []
-
-        if not self.config.orm:
-            logging.info(f"Color:\t\t\t{material.color_path}\n")
-            logging.info(f"Ambient Occlusion:\t\t{material.ao_path}\n")
-            logging.info(f"Normal:\t\t\t{material.normal_path}\n")
-            logging.info(f"Metallic:\t\t\t{material.metallic_path}\n")
-            logging.info(f"Roughness:\t\t\t{material.roughness_path}\n")
-
-            if self.config.input_normal != '':
-                normal_image = Image.open(material.normal_path)
-                normal_image = self.fix_scale_mismatch(normal_image, normal_image, True)
-            color_image = Image.open(material.color_path)
-            color_image = self.fix_scale_mismatch(normal_image, color_image)
-            if self.config.input_ao != '':
-                if material.ao_path is None:
-                    ao_image = Image.new('RGB', color_image.size, (255, 255, 255))
-                else:
-                    ao_image = Image.open(material.ao_path)
-                    ao_image = self.fix_scale_mismatch(normal_image, ao_image)
-            if self.config.input_metallic != '':
-                if material.metallic_path is None:
-                    metal_image = Image.new('RGB', color_image.size, (0, 0, 0))
-                else:
-                    metal_image = Image.open(material.metallic_path)
-                    metal_image = self.fix_scale_mismatch(normal_image, metal_image)
-            if self.config.input_roughness != '':
-                if material.roughness_path is None:
-                    gloss_image = Image.new('RGB', color_image.size, (255, 255, 255))
-                else:
-                    gloss_image = Image.open(material.roughness_path)
-                    gloss_image = self.fix_scale_mismatch(normal_image, gloss_image)
-                if self.config.material_setup == "rough":
-                    gloss_image = ImageOps.invert(gloss_image.convert('RGB'))
+        def open_source(name: str):
+            if name not in opened:
+                opened[name] = self.open_source(files[name], size)
+            return opened[name]
 
-            if self.config.input_ao != '':
-                processes.append(multiprocessing.Process(target=self.do_diffuse, args=(color_image, ao_image, metal_image, gloss_image, material.name,)))
+        if "color" in maps:
+            sources["color"] = open_source("color")
+        if "normal" in maps:
+            sources["normal"] = open_source("normal")
+        packed = {}
+        routed = {ROUTE_TARGETS[target]: route for target, route in self.config.channel_routes.items()}
+        for role, (name, channel) in routed.items():
+            if role not in maps:
+                continue
+            if files.get(name) is None:
+                sources[role] = ConstantSource('L', size, MAP_DEFAULTS[role])
+                continue
+            if name not in packed:
+                source = open_source(name)
+                packed[name] = PackedSource(source, "RGBA" if source.has_alpha() else "RGB")
+            if CHANNELS.index(channel) >= len(packed[name].mode):
+                logging.warning(f"{os.path.basename(files[name])} has no {channel} channel for the {role} map, "
+                                f"using the default\n")
+                sources[role] = ConstantSource('L', size, MAP_DEFAULTS[role])
             else:
-                processes.append(multiprocessing.Process(target=self.do_diffuse, args=(color_image, None, metal_image, gloss_image, material.name,)))
+                sources[role] = ChannelSource(packed[name], CHANNELS.index(channel))
+        for role, setting, path in (("ao", self.config.input_ao, material.ao_path),
+                                    ("metallic", self.config.input_metallic, material.metallic_path),
+                                    ("gloss", self.config.input_roughness, material.roughness_path)):
+            if setting != '' and role in maps and role not in routed:
+                if path is None:
+                    sources[role] = ConstantSource('L', size, MAP_DEFAULTS[role])
+                else:
+                    sources[role] = self.open_source(path, size)
+        return sources
+
+    def read_maps(self, sources: dict, top: int, bottom: int) -> dict:
+        return {role: source.rows(top, bottom) for role, source in sources.items()}
+
+    def decode_maps(self, maps: dict, forms: set) -> dict:
+        # The array forms of one band that the cache keeps, see TEXTURE_FORMS
+        arrays = {}
+        for role in forms & {"color", "ao", "metallic", "normal"}:
+            if maps.get(role) is not None:
+                mode = {"color": "RGB", "metallic": "L"}.get(role, storage_mode(image_mode(maps[role])))
+                if role == "normal":
+                    mode = "RGBA" if mode == "RGBA" else "RGB"
+                arrays[role] = as_array(maps[role], mode)
+        if maps.get("gloss") is None or not forms & {"gloss", "gloss_gamma"}:
+            return arrays
+        # Roughness is inverted through the same tables as the gamma, its alpha is dropped
+        invert = self.gloss_inverted()
+        mode = storage_mode(image_mode(maps["gloss"]))
+        gloss = as_array(maps["gloss"], mode[:3] if invert else mode)
+        if "gloss" in forms:
+            arrays["gloss"] = channel_lut(invert)[gloss] if invert else gloss
+        if "gloss_gamma" in forms:
+            with profiler.stage("gamma"):
+                arrays["gloss_gamma"] = self.gloss_gamma(gloss, invert)
+        return arrays
+
+    def gloss_inverted(self) -> bool:
+        # Whether the gloss map holds roughness, a routed channel says so by its name
+        for target in ("roughness", "gloss"):
+            if target in self.config.channel_routes:
+                return target == "roughness"
+        return self.config.material_setup == "rough"
+
+    def pack_texture(self, texture_type: TextureType, maps: dict) -> np.ndarray:
+        with profiler.stage("packing"):
+            profiler.count(read=sum(image.nbytes for image in maps.values() if image is not None))
+            if texture_type == TextureType.DIFFUSE:
+                return self.do_diffuse(maps["color"], maps.get("ao"), maps.get("metallic"), maps.get("gloss"))
+            if texture_type == TextureType.EXPONENT:
+                return self.do_exponent(maps.get("gloss"))
+            return self.do_normal(maps["normal"], maps.get("gloss_gamma"))
+
+    def decode_material(self, material: Material, texture_types: list, cache_path: str,
+                        in_memory: bool = False) -> "MaterialCache":
+        # Runs inside a worker. Decodes each source once, in bands, into the forms the
+        # textures need and stores them as memory-mapped arrays for the other workers
+        size = self.output_size(material)
+        sources = self.open_maps(material, texture_types, size)
+        forms = set().union(*(TEXTURE_FORMS[t] for t in texture_types))
+        cache = MaterialCache(None if in_memory else tempfile.mkdtemp(prefix="material-", dir=cache_path), size)
+        try:
+            rows = self.band_rows(*size)
+            for top in range(0, size[1], rows):
+                bottom = min(top + rows, size[1])
+                with profiler.stage("decode"):
+                    for role, band in self.decode_maps(self.read_maps(sources, top, bottom), forms).items():
+                        cache.create(role, band)[top:bottom] = band
+                        cache.check_uniform(role, band)
+                        profiler.count(written=band.nbytes)
+        except BaseException:
+            cache.evict()
+            raise
+        return cache.close()
+
+    def convert_material(self, material: Material, texture_type: TextureType, cache: "MaterialCache"):
+        # Runs inside a worker. Packs and compresses the texture in bands of rows
+        # from the decoded maps in the material cache
+        size = cache.size
+        maps = {role: cache.open(role) for role in TEXTURE_FORMS[texture_type] if role in cache.maps}
+        if self.config.shrink_uniform and all(cache.uniform[role] for role in maps):
+            # Packed from single color maps only, the texture is one color too
+            size = (min(size[0], UNIFORM_SIZE), min(size[1], UNIFORM_SIZE))
+            maps = {role: image[:size[1], :size[0]] for role, image in maps.items()}
+        rows = self.band_rows(*size)
+        bands = (self.pack_texture(texture_type, {role: image[top:top + rows] for role, image in maps.items()})
+                 for top in range(0, size[1], rows))
+        logging.debug(f"Exporting {material.name}_{texture_type.value}...\n")
+        if texture_type == TextureType.DIFFUSE:
+            return self.export_texture(bands, size, material.name, texture_type, 'DXT5')
+        elif texture_type == TextureType.EXPONENT:
+            return self.export_texture(bands, size, material.name, texture_type,
+                                       'DXT5' if self.config.force_compression else 'DXT1')
         else:
-            logging.info(f"Color:\t\t {material.color_path}\n")
-            logging.info(f"ORM:\t\t {material.ao_path}\n")
-            logging.info(f"Normal:\t\t {material.normal_path}\n")
-
-            color_image = Image.open(material.color_path)
-            ormImage = Image.open(material.ao_path)
-            normal_image = Image.open(material.normal_path)
-            if ormImage.width != color_image.width or ormImage.height != color_image.height:
-                ormImage = ormImage.resize((color_image.width, color_image.height),
-                                               Image.Resampling.LANCZOS)
-            try:
-                (ao_image, roughness, metal_image, _) = ormImage.split()
-            except Exception:
-                logging.info(
-                        "ERROR: Could not convert color bands on ORM! (Do you have empty image channels?)\n")
-            gloss_image = ImageOps.invert(roughness.convert('RGB'))
-            processes.append(multiprocessing.Process(target=self.do_diffuse, args=(color_image, ao_image, metal_image, gloss_image, material.name,)))
-        processes.append(multiprocessing.Process(target=self.do_exponent, args=(gloss_image, material.name,)))
-        processes.append(multiprocessing.Process(target=self.do_normal, args=(normal_image, gloss_image, material.name,)))
-        processes.append(multiprocessing.Process(target=self.do_material, args=(material.name,)))
-        logging.info(f"Pre conversion for material '{material.name}.vmt' finished\n")
-        return processes
-    
+            return self.export_texture(bands, size, material.name, texture_type,
+                                       'DXT5' if self.config.force_compression else 'RGBA8888')
+
+    def convert_in_memory(self, name: str, inputs: dict) -> dict:
+        # See convert_material(), converts in this thread without the output folder or the manifest
+        roles = ("color", "orm" if self.config.orm and not self.config.preset else "ao", "normal", "metallic", "roughness")
+        unknown = inputs.keys() - set(roles) - set(self.config.channel_sources)
+        if unknown:
+            raise ValueError(f"Unknown input maps: {', '.join(sorted(unknown))} (expected {', '.join(roles)})")
+        missing = [role for role in ("color", "normal") if inputs.get(role) is None]
+        if missing:
+            raise ValueError(f"Missing input maps: {', '.join(missing)}")
+        material = Material(name, *(inputs.get(role) for role in roles),
+                            {source: inputs[source] for source in self.config.channel_sources if source in inputs})
+        cache = self.decode_material(material, list(TextureType), None, in_memory=True)
+        outputs = {}
+        try:
+            for texture_type in TextureType:
+                for profile, file, data in self.convert_material(material, texture_type, cache):
+                    outputs[file if profile is None else f"{profile}/{file}"] = data
+        finally:
+            cache.evict()
+        for profile, output_path in self.output_paths().items():
+            prefix = "" if profile is None else f"{profile}/"
+            outputs[f"{prefix}{name}.vmt"] = self.material_vmt(name, output_path=output_path)
+            if self.config.phongwarps and not self.config.clear_exponent:
+                outputs[f"{prefix}phongwarp_steel.vtf"] = phongwarp_data()
+        return outputs
+
+    def scan_inputs(self):
+        # Lists the input folder once (and its subfolders when Recursive is on), output folders are left out
+        output_paths = {os.path.realpath(path) for path in self.output_paths().values()}
+        folders = [str(self.config.input_path)]
+        while folders:
+            with os.scandir(folders.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        if self.config.input_recursive and os.path.realpath(entry.path) not in output_paths:
+                            folders.append(entry.path)
+                    elif entry.is_file():
+                        yield entry
+
     def find_materials(self):  # Uses the color map to determine the current material name
+        self.index = {}
+        for entry in self.scan_inputs():
+            self.index_path(entry.path)
+        return self.materials()
+
+    def index_path(self, path: str, exists: bool = True):
+        # Adds (or removes) an input file to the index, returns the name of its material
+        stem, extension = os.path.splitext(os.path.basename(path))
+        # Earlier formats in the config win when a map exists in several formats
+        if extension[1:].lower() not in self.config.input_formats:
+            return None
+        priority = self.config.input_formats.index(extension[1:].lower())
+        # Longest suffixes are matched first, so "_N" never steals files ending in "_AO_N" or similar
+        suffixes = sorted(((suffix, role) for role, suffix in (
+            ("color", self.config.input_color), ("ao", self.config.input_ao), ("normal", self.config.input_normal),
+            ("metallic", self.config.input_metallic), ("roughness", self.config.input_roughness),
+            *self.config.channel_sources.items()) if suffix),
+            key=lambda item: len(item[0]), reverse=True)
+        for suffix, role in suffixes:
+            if len(stem) > len(suffix) and stem.endswith(suffix):
+                folder = os.path.relpath(os.path.dirname(path), self.config.input_path)
+                name = Path(folder, stem[:-len(suffix)]).as_posix()
+                candidates = self.index.setdefault(name, {}).setdefault(role, {})
+                if exists:
+                    candidates[priority] = path
+                elif candidates.get(priority) == path:
+                    del candidates[priority]
+                return name
+        return None
+
+    def materials(self, names=None) -> list:
+        # Materials of the index (or only the given ones) that have their required maps
         list_stuff: list[Material] = []
-        for file in glob.glob(f"{self.config.input_path}/*{self.config.input_color}.{self.config.input_format}"):
-            if self.config.input_color in file:
-                name = file.replace(f"{self.config.input_path}\\", "")
-                name = name.replace(f"{self.config.input_color}.{self.config.input_format}", "")
-                list_stuff.append(Material(name, file))
-        # find other textures maps
-        for material in list_stuff:
-            for file in glob.glob(f"{self.config.input_path}/{material.name}*.{self.config.input_format}"):
-                if file.endswith(f"{self.config.input_ao}.{self.config.input_format}"):
-                    material.ao_path = file
-                elif file.endswith(f"{self.config.input_normal}.{self.config.input_format}"):
-                    material.normal_path = file
-                elif file.endswith(f"{self.config.input_metallic}.{self.config.input_format}"):
-                    material.metallic_path = file
-                elif file.endswith(f"{self.config.input_roughness}.{self.config.input_format}"):
-                    material.roughness_path = file
+        for name in sorted(self.index if names is None else names):
+            maps = {role: candidates[min(candidates)] for role, candidates in self.index.get(name, {}).items()
+                    if candidates}
+            if "color" not in maps:
+                continue
+            if "normal" not in maps:
+                logging.warning(f"Skipping material '{name}', no normal map found\n")
+                continue
+            list_stuff.append(Material(name, maps["color"], maps.get("ao"), maps.get("normal"),
+                                       maps.get("metallic"), maps.get("roughness"),
+                                       {source: maps[source] for source in self.config.channel_sources if source in maps}))
         return list_stuff
-    
-    def convert(self):
-        for material_name in self.find_materials():  # For every material in the input folder
-            all_processes.extend(self.convert_material(material_name))
-            # MAXIMUM THREAD COUNT
-            for i in range(0, len(all_processes), config.thread_count):
-                for process in all_processes[i:i + config.thread_count]:
-                    process.start()
-                for process in all_processes[i:i + config.thread_count]:
-                    process.join()
-            logging.info(f"Conversion finished, files saved to '{config.output_path}'\n")
-        
+
+    def source_paths(self, material: Material) -> dict:
+        # Input files by source name, as used in channel routes
+        return {"color": material.color_path, "ao": material.ao_path, "normal": material.normal_path,
+                "metallic": material.metallic_path, "roughness": material.roughness_path, **material.packed}
+
+    def map_paths(self, material: Material) -> dict:
+        # Input file of every map role, routed maps come from their source
+        files = self.source_paths(material)
+        paths = {"color": material.color_path, "ao": material.ao_path, "normal": material.normal_path,
+                 "metallic": material.metallic_path, "gloss": material.roughness_path}
+        for target, (source, _) in self.config.channel_routes.items():
+            paths[ROUTE_TARGETS[target]] = files.get(source)
+        return paths
+
+    def material_inputs(self, material: Material, kind) -> list:
+        # The normal (or the color map in ORM mode) sets the size of every output
+        roles = {"color", "normal"} | (TEXTURE_MAPS[kind] if kind in TEXTURE_MAPS else set())
+        paths = self.map_paths(material)
+        return sorted({paths[role] for role in roles if paths[role] is not None})
+
+    def probe_material(self, material: Material, cache: BuildCache = None) -> tuple:
+        # Reads the header of every map, raises for unreadable ones. Returns the output size
+        for path in self.map_paths(material).values():
+            if isinstance(path, (str, os.PathLike)):
+                ImageReaders.probe(path)
+        return self.output_size(material, cache)
+
+    def fingerprint(self, cache: BuildCache, material: Material, texture_type: TextureType) -> str:
+        # Equal for textures that come out byte for byte the same: the content of the maps they're
+        # packed from, the output size and the settings. The size reference only counts with its size
+        paths = self.map_paths(material)
+        maps = {role: cache.file_hash(paths[role]) if paths[role] else None for role in sorted(TEXTURE_MAPS[texture_type])}
+        key = [texture_type.value, maps, self.output_size(material, cache), cache.settings_hash(self.config, texture_type),
+               OUTPUT_REVISION]
+        return hashlib.blake2b(json.dumps(key).encode(), digest_size=16).hexdigest()
+
+    def update_fingerprints(self, cache: BuildCache, materials: list, full: bool, removed: set) -> tuple:
+        # Fingerprints of the given materials, the others keep theirs from the last build. Returns the
+        # materials whose textures may be shared differently now: the given ones and those with a
+        # fingerprint they had before or have now. And the names of materials with unreadable maps
+        if full:
+            cache.fingerprints = {}
+        touched = set()
+        for name in removed:
+            touched.update(cache.fingerprints.pop(name, {}).values())
+        readable, skipped = [], set()
+        for material in materials:
+            try:
+                fingerprints = {t.value: self.fingerprint(cache, material, t) for t in TextureType}
+            except (OSError, SyntaxError, ValueError) as e:
+                logging.error(f"Skipping material '{material.name}', a map can't be read: {e}\n")
+                skipped.add(material.name)
+                continue
+            touched.update(cache.fingerprints.get(material.name, {}).values())
+            touched.update(fingerprints.values())
+            cache.fingerprints[material.name] = fingerprints
+            readable.append(material)
+        if full:
+            return readable, skipped
+        names = {name for name, fingerprints in cache.fingerprints.items()
+                 if not touched.isdisjoint(fingerprints.values())}
+        readable += self.materials(names - {material.name for material in readable})
+        return sorted(readable, key=lambda material: material.name), skipped
+
+    def add_profile(self, material: str, texture: str, snapshot: dict):
+        # Stage totals of a finished task, summed over all workers and per material
+        self.profile.merge(snapshot["stages"])
+        if material:
+            self.material_profiles.setdefault(material, Profiler()).merge(snapshot["stages"])
+        if self.trace is not None and snapshot["events"]:
+            self.trace.write(snapshot["events"], material, texture)
+
+    def log_profile(self):
+        logging.info("Time per stage, summed over all workers:\n")
+        for stage, totals in sorted(self.profile.stages.items(), key=lambda item: -item[1]["wall"]):
+            logging.info(f"{stage}: {totals['wall']:.2f}s wall, {totals['cpu']:.2f}s CPU, "
+                         f"{totals['read'] / 2 ** 20:.1f} MB read, {totals['written'] / 2 ** 20:.1f} MB written, "
+                         f"peak {totals['peak_rss'] / 2 ** 20:.0f} MB\n")
+        slowest = sorted(self.material_profiles.items(),
+                         key=lambda item: -sum(totals["wall"] for totals in item[1].stages.values()))
+        for name, material_profile in slowest[:5]:
+            stage, totals = max(material_profile.stages.items(), key=lambda item: item[1]["wall"])
+            wall = sum(totals["wall"] for totals in material_profile.stages.values())
+            logging.info(f"Slowest: {name} {wall:.2f}s ({stage} {totals['wall']:.2f}s)\n")
+
+    def worker_count(self) -> int:
+        if sys.platform == "win32":
+            return min(self.config.thread_count, 61)  # ProcessPoolExecutor limit on Windows
+        return self.config.thread_count
+
+    def create_pool(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers=self.worker_count(), initializer=init_worker,
+                                   initargs=(self.config, logging.getLogger().getEffectiveLevel()))
+
+    def convert(self, materials: list = None, removed: set = frozenset()):
+        # Converts every material in the input folder, or only the given ones (watch mode).
+        # removed: materials that lost their maps since the last call, for deduplication
+        # Stage totals over all workers and per material, see Profiler
+        self.profile = Profiler()
+        self.material_profiles: dict[str, Profiler] = {}
+        self.trace = None if self.config.profile_path is None else TraceWriter(self.config.profile_path)
+        profiler.reset(trace=self.trace is not None)
+        full = materials is None
+        if full:
+            with profiler.stage("scan"):
+                materials = self.find_materials()
+        targets = self.targets if self.targets is not None else self.open_outputs()
+        cache = self.cache if self.cache is not None else BuildCache(self.manifest_path(), list(targets.values()))
+        # Output each texture shares its content with, the first material that has it builds it
+        sources: dict[str, str] = {}
+        skipped = set()
+        if self.config.deduplicate != "off":
+            with profiler.stage("scan"):
+                # A changed map can make textures of other materials (un)shared, those with a
+                # fingerprint in common are checked too
+                materials, skipped = self.update_fingerprints(cache, materials, full, removed)
+                first = cache.sources()
+                for material in materials:
+                    for texture_type in TextureType:
+                        name = texture_name(material.name, texture_type)
+                        sources[name] = first[cache.fingerprints[material.name][texture_type.value]]
+        skipped = {output for name in skipped for output in [f"{name}.vmt"] + [texture_name(name, t) for t in TextureType]}
+        # Shared textures by the output they wait for
+        followers: dict[str, list] = {}
+        tasks = 0
+        states = {}
+        # Outputs still missing per material, the VMT is written once they're all done
+        pending: dict[str, list] = {}
+        # Textures each material converts itself
+        builds: dict[str, list] = {}
+        for material in materials:
+            logging.debug(f"Color: {material.color_path}, AO/ORM: {material.ao_path}, Normal: {material.normal_path}, "
+                          f"Metallic: {material.metallic_path}, Roughness: {material.roughness_path}\n")
+            pending[material.name] = []
+            builds[material.name] = []
+            for kind in list(TextureType) + ["vmt"]:
+                name = f"{material.name}.vmt" if kind == "vmt" else texture_name(material.name, kind)
+                states[name] = cache.state(self.config, kind, self.material_inputs(material, kind))
+                if kind == "vmt" and self.config.deduplicate == "reference":
+                    textures = {t.value: sources[texture_name(material.name, t)][:-len(".vtf")] for t in TextureType
+                                if sources[texture_name(material.name, t)] != texture_name(material.name, t)}
+                    if textures:
+                        states[name]["textures"] = textures
+                elif sources.get(name, name) != name and self.config.deduplicate == "reference":
+                    states[name]["source"] = sources[name]
+                if not self.config.force_rebuild and cache.is_current(name, states[name]):
+                    logging.debug(f"'{name}' is up to date, skipping\n")
+                elif kind != "vmt":
+                    pending[material.name].append(kind)
+                    if sources.get(name, name) != name:
+                        followers.setdefault(sources[name], []).append((material, kind))
+                    else:
+                        builds[material.name].append(kind)
+                        tasks += 1
+        if full:
+            # Also when no material is left, an empty input folder leaves no outputs behind
+            cache.remove_orphans(set(states) | skipped)
+
+        def finish_material(material: Material):
+            name = f"{material.name}.vmt"
+            if self.config.force_rebuild or not cache.is_current(name, states[name]):
+                with profiler.stage("write"):
+                    self.do_material(material.name, targets, states[name].get("textures"))
+                cache.record(name, states[name])
+                logging.info(f"Material '{name}' finished\n")
+
+        caches: dict[str, MaterialCache] = {}
+        failed = set()
+
+        def texture_done(material: Material, texture_type: TextureType):
+            pending[material.name].remove(texture_type)
+            if not pending[material.name]:
+                # All textures are written, the decoded maps aren't needed anymore
+                if material.name in caches:
+                    caches.pop(material.name).evict()
+                if material.name not in failed:
+                    finish_material(material)
+
+        def share(material: Material, texture_type: TextureType, built: bool = True):
+            # Completes a texture whose content another output has, once that output is written
+            name = texture_name(material.name, texture_type)
+            if built:
+                try:
+                    with profiler.stage("write"):
+                        for target in targets.values():
+                            if self.config.deduplicate == "link":
+                                target.link(sources[name], name)
+                            else:
+                                target.remove(name)
+                except OSError as e:
+                    logging.error(f"Could not share {sources[name]} as {name}: {e}\n")
+                    built = False
+                else:
+                    logging.debug(f"'{name}' shares '{sources[name]}'\n")
+                    cache.record(name, states[name])
+            if not built:
+                failed.add(material.name)
+            texture_done(material, texture_type)
+
+        def share_all(name: str, built: bool = True):
+            for material, texture_type in followers.pop(name, []):
+                share(material, texture_type, built)
+
+        # Only the maps of materials that get decoded are probed, from their headers. Materials with
+        # unreadable maps are skipped before anything is decoded and their outputs are kept
+        sizes = {}
+        with profiler.stage("scan"):
+            for material in materials:
+                if not builds[material.name]:
+                    continue
+                try:
+                    sizes[material.name] = self.probe_material(material, cache)
+                except (OSError, SyntaxError, ValueError) as e:
+                    logging.error(f"Skipping material '{material.name}', a map can't be read: {e}\n")
+                    failed.add(material.name)
+                    tasks -= len(builds[material.name])
+                    for texture_type in builds[material.name]:
+                        share_all(texture_name(material.name, texture_type), built=False)
+                        texture_done(material, texture_type)
+                    builds[material.name] = []
+        shared = sum(len(waiting) for waiting in followers.values())
+        logging.info(f"{tasks} textures to convert, {shared} shared, "
+                     f"{len(materials) * len(TextureType) - tasks - shared} up to date\n")
+        progress = Progress(tasks)
+        # Textures whose output is already up to date are shared right away
+        building = {texture_name(material.name, kind) for material in materials for kind in builds[material.name]}
+        for name in [name for name in followers if name not in building]:
+            share_all(name)
+        for material in materials:
+            if not pending[material.name] and material.name not in failed:
+                finish_material(material)
+        workers = self.worker_count()
+        # Largest first, so the big materials don't end up alone on one worker at the end
+        queue = deque(sorted((material for material in materials if builds[material.name]),
+                             key=lambda material: -sizes[material.name][0] * sizes[material.name][1]))
+        cache_path = tempfile.mkdtemp(prefix="fvm-", dir=self.config.cache_path)
+        pool = self.pool if self.pool is not None else self.create_pool()
+        # Encoded outputs are written in the background while the workers keep compressing
+        writer = ThreadPoolExecutor(WRITE_THREADS, thread_name_prefix="fvm-write")
+        queued_bytes = 0
+        try:
+            running = {}
+
+            def decode_next():
+                # Keeps a bounded number of decoded materials around
+                while queue and len(caches) + sum(stage == "decode" for stage, *_ in running.values()) < workers:
+                    material = queue.popleft()
+                    running[pool.submit(decode_material, material, builds[material.name], cache_path)] = \
+                        ("decode", material, None)
+
+            decode_next()
+            while running:
+                # Only wait for the writers while too much encoded data is queued for them
+                writes = [future for future, (stage, *_) in running.items() if stage == "write"]
+                done, _ = wait(writes if queued_bytes > WRITE_QUEUE_BYTES else running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, material, texture_type, *queued = running.pop(future)
+                    if stage == "decode":
+                        try:
+                            caches[material.name], snapshot = future.result()
+                            self.add_profile(material.name, "decode", snapshot)
+                        except BrokenProcessPool:
+                            raise
+                        except Exception as e:
+                            logging.error(f"Could not decode {material.name}: {e}\n")
+                            progress.total -= len(builds[material.name])
+                            failed.add(material.name)
+                            for texture_type in builds[material.name]:
+                                share_all(texture_name(material.name, texture_type), built=False)
+                                texture_done(material, texture_type)
+                            continue
+                        for texture_type in builds[material.name]:
+                            running[pool.submit(convert_texture, material, texture_type, caches[material.name])] = \
+                                ("texture", material, texture_type)
+                        continue
+                    if stage == "write":
+                        queued_bytes -= queued[0]
+                        name = texture_name(material.name, texture_type)
+                        try:
+                            self.add_profile(material.name, texture_type.value, future.result())
+                        except Exception as e:
+                            logging.error(f"Could not write {material.name}_{texture_type.value}: {e}\n")
+                            failed.add(material.name)
+                            share_all(name, built=False)
+                        else:
+                            # Only recorded once the file is in place
+                            logging.info(f"{progress.update()} - exported {material.name}_{texture_type.value}\n")
+                            cache.record(name, states[name])
+                            share_all(name)
+                        texture_done(material, texture_type)
+                        continue
+                    try:
+                        outputs, snapshot = future.result()
+                        self.add_profile(material.name, texture_type.value, snapshot)
+                    except BrokenProcessPool:
+                        raise
+                    except Exception as e:
+                        logging.error(f"Could not convert {material.name}_{texture_type.value}: {e}\n")
+                        failed.add(material.name)
+                        share_all(texture_name(material.name, texture_type), built=False)
+                        texture_done(material, texture_type)
+                        continue
+                    queued = sum(len(data) for *_, data in outputs)
+                    queued_bytes += queued
+                    running[writer.submit(write_outputs, targets, outputs, self.trace is not None)] = \
+                        ("write", material, texture_type, queued)
+                decode_next()
+        finally:
+            if pool is not self.pool:
+                pool.shutdown(cancel_futures=True)
+            # Writes that already started are finished, the rest is dropped and rebuilt next run
+            writer.shutdown(cancel_futures=True)
+            for material_cache in caches.values():
+                material_cache.evict()
+            shutil.rmtree(cache_path, ignore_errors=True)
+            # Packages get their directory before the manifest records what's in them
+            for target in targets.values():
+                target.flush() if targets is self.targets else target.close()
+            cache.save()
+            self.add_profile("", "main", profiler.snapshot())
+            if self.trace is not None:
+                self.trace.close()
+        if full:
+            self.log_profile()
+        logging.info(f"Conversion finished, files saved to '{self.config.package_path or self.config.output_path}'\n")
+
+    def watch(self):
+        # Converts everything once, then only the outputs of input files that change.
+        # The workers, the manifest and the material index stay loaded in between
+        self.pool = self.create_pool()
+        self.targets = self.open_outputs()
+        self.cache = BuildCache(self.manifest_path(), list(self.targets.values()))
+        watcher = InputWatcher(self)
+        try:
+            self.convert()
+            # --force only applies to the first build, later changes rebuild what they affect
+            self.config.force_rebuild = False
+            watcher.start()
+            logging.info(f"Watching '{self.config.input_path}' for changes ({watcher.method}), press Ctrl+C to stop\n")
+            while True:
+                names = set()
+                for path in watcher.changes():
+                    # Events can be stale by now, the file system has the last word
+                    name = self.index_path(path, os.path.isfile(path))
+                    if name is not None:
+                        names.add(name)
+                if not names:
+                    continue
+                materials = self.materials(names)
+                # Outputs of materials that lost their color or normal map are removed
+                found = {material.name for material in materials}
+                removed = names - found
+                for name in removed:
+                    for output in [texture_name(name, t) for t in TextureType] + [f"{name}.vmt"]:
+                        if output in self.cache.outputs:
+                            self.cache.remove(output)
+                for target in self.targets.values():
+                    target.flush()
+                self.cache.save()
+                if not materials and not removed:
+                    continue
+                try:
+                    self.convert(materials, removed)
+                except BrokenProcessPool:
+                    logging.error("A worker process died, restarting the workers\n")
+                    self.pool.shutdown(wait=False)
+                    self.pool = self.create_pool()
+        except KeyboardInterrupt:
+            logging.info("Stopped watching\n")
+        finally:
+            watcher.stop()
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+            self.cache = None
+            for target in self.targets.values():
+                target.close()
+            self.targets = None
+
+
+class InputWatcher:
+    """ Collects changed input files, from watchdog events or by polling the input folder
+
+    changes() waits until something changed and then for WATCH_DELAY seconds
+    without further changes, so a burst of saves becomes one conversion.
+    """
+    def __init__(self, converter: FastValveMaterial):
+        self.converter = converter
+        self.output_paths = [os.path.realpath(path) for path in converter.output_paths().values()]
+        self.observer = load_watchdog()
+        self.method = "watchdog" if self.observer is not None else "polling"
+        self.changed: set[str] = set()
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.observer is not None:
+            self.thread = self.observer()
+            self.thread.schedule(WatchdogHandler(self), str(self.converter.config.input_path),
+                                 recursive=self.converter.config.input_recursive)
+        else:
+            self.thread = threading.Thread(target=self.poll, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is None:
+            return
+        if self.observer is not None:
+            self.thread.stop()
+        self.thread.join()
+
+    def add(self, path: str):
+        if any(os.path.realpath(path).startswith(output_path + os.sep) for output_path in self.output_paths):
+            return
+        with self.lock:
+            self.changed.add(path)
+        self.event.set()
+
+    def changes(self) -> set:
+        # Paths that were created, changed or removed
+        self.event.wait()
+        while True:
+            self.event.clear()
+            if not self.event.wait(WATCH_DELAY):
+                break
+        with self.lock:
+            changed, self.changed = self.changed, set()
+        return changed
+
+    def snapshot(self) -> dict:
+        return {entry.path: (entry.stat().st_size, entry.stat().st_mtime_ns)
+                for entry in self.converter.scan_inputs()}
+
+    def poll(self):
+        previous = self.snapshot()
+        while not self.stopped.wait(POLL_INTERVAL):
+            try:
+                current = self.snapshot()
+            except OSError:
+                continue  # A folder vanished while it was listed, try again next time
+            for path in previous.keys() - current.keys():
+                self.add(path)
+            for path, stat in current.items():
+                if previous.get(path) != stat:
+                    self.add(path)
+            previous = current
+
+
+class WatchdogHandler:
+    """ Event handler for the watchdog observer, which only calls dispatch() """
+    def __init__(self, watcher: InputWatcher):
+        self.watcher = watcher
+
+    def dispatch(self, event):
+        if event.is_directory or event.event_type not in WATCH_EVENTS:
+            return
+        self.watcher.add(event.src_path)
+        if event.event_type == "moved":
+            self.watcher.add(event.dest_path)
+
+
+# /////////////////////
+# Library
+# /////////////////////
+def convert_material(inputs: dict, settings=None, name: str = "material") -> dict:
+    """ Convert one material in memory, for use as a library
+
+    inputs: map role -> encoded file bytes, a path, a PIL image or a uint8 array.
+    Roles are "color", "normal", "ao", "metallic" and "roughness" (the gloss map
+    with MaterialSetup gloss), "orm" instead of the last three with ORM on, and
+    the packed sources of the preset.
+    settings: a Config, or Config fields to change from the defaults, e.g.
+    {"material_setup": "gloss", "output_path": "materials/models/props"}. The
+    output path only sets the texture paths in the VMT, nothing is written.
+
+    Returns {file name: content}: the VTFs (and exported images) as bytes and the
+    VMT as text. Outputs of the profiles are named "<profile>/<file name>". Safe
+    to call from several threads at once.
+    """
+    if not isinstance(settings, Config):
+        settings = Config(None).update(settings or {})
+    return FastValveMaterial(settings).convert_in_memory(name, inputs)
+
+
+# /////////////////////
+# Worker processes
+# /////////////////////
+worker: FastValveMaterial = None
+
+def init_worker(config: Config, log_level: int):
+    # Every pool process keeps one converter (and encoder) for its whole lifetime.
+    # Spawned workers (Windows) start without the logging of the main process
+    global worker
+    # Ctrl+C is handled by the main process, which shuts the pool down and removes the caches
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if not logging.getLogger().handlers:
+        setup_logging(log_level)
+    worker = FastValveMaterial(config)
+
+def decode_material(material: Material, texture_types: list, cache_path: str):
+    profiler.reset(trace=worker.config.profile_path is not None)
+    return worker.decode_material(material, texture_types, cache_path), profiler.snapshot()
+
+def convert_texture(material: Material, texture_type: TextureType, cache: MaterialCache):
+    profiler.reset(trace=worker.config.profile_path is not None)
+    return worker.convert_material(material, texture_type, cache), profiler.snapshot()
+
 if __name__ == "__main__":
     # Nuitka fix for multiprocessing
     multiprocessing.freeze_support()
@@ -461,11 +2180,17 @@ if __name__ == "__main__":
     args.add_argument("-c", "--config", help="Config file to use", default="config.ini")
     args.add_argument("-i", "--input", help="Input folder to use")
     args.add_argument("-o", "--output", help="Output folder to use")
+    args.add_argument("-p", "--package", help="Write the outputs into this VPK (<name>_dir.vpk) instead of loose files")
     args.add_argument("-t", "--threads", help="Thread count to use")
     args.add_argument("-d", "--debug", help="Enable debug messages", action="store_true")
     args.add_argument("-f", "--fast-export", help="Enable fast export", action="store_true")
     args.add_argument("-e", "--export", help="Export images", action="store_true")
+    args.add_argument("-F", "--force", help="Rebuild all outputs, even if they are up to date", action="store_true")
+    args.add_argument("-w", "--watch", help="Keep running and convert materials again when their maps change",
+                      action="store_true")
+    args.add_argument("-P", "--profile", help="Write stage timings to a Chrome trace (.json) or JSON lines (.jsonl) file")
     args = args.parse_args()
+    setup_logging()
     config = Config(args.config)
 
     # /////////////////////
@@ -484,7 +2209,10 @@ if __name__ == "__main__":
     # Main loop
     # /////////////////////
     fast_valve_material = FastValveMaterial(config, args)
-    fast_valve_material.convert()
+    if args.watch:
+        fast_valve_material.watch()
+    else:
+        fast_valve_material.convert()
     
     # /////////////////////
     # Finish
@@ -0,0 +1,238 @@
+""" Header-only probing and fast path readers for TGA, PNG and DDS maps
+
+probe() reads the size and mode of an image from its header without decoding
+any pixels. open_reader() returns a reader that hands out horizontal bands as
+uint8 arrays: uncompressed TGA and DDS files are memory-mapped, so bands are
+views of the file, BC1/BC3 (DXT1/DXT5) DDS files are decoded band by band with
+numpy. Anything else returns None and is left to PIL.
+"""
+
+import os
+import struct
+from abc import ABC, abstractmethod
+from typing import NamedTuple
+
+import numpy as np
+from PIL import Image
+
+TGA_HEADER = 18
+TGA_TRUECOLOR = 2
+TGA_GRAYSCALE = 3
+TGA_TOP_LEFT = 0x20
+TGA_RIGHT_TO_LEFT = 0x10
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# (bit depth, color type) -> mode, as PIL opens them
+PNG_MODES = {(1, 0): "1", (2, 0): "L", (4, 0): "L", (8, 0): "L", (16, 0): "I",
+             (8, 2): "RGB", (16, 2): "RGB", (1, 3): "P", (2, 3): "P", (4, 3): "P", (8, 3): "P",
+             (8, 4): "LA", (16, 4): "RGBA", (8, 6): "RGBA", (16, 6): "RGBA"}
+DDS_HEADER = 128
+DDS_DX10_HEADER = 20
+DDPF_FOURCC = 0x4
+DDPF_RGB = 0x40
+# DXGI formats of the DX10 header extension
+DXGI_BC1 = (70, 71, 72)
+DXGI_BC3 = (76, 77, 78)
+DXGI_RGBA8 = (27, 28, 29)
+# Bytes per 4x4 block
+BC1_BLOCK = 8
+BC3_BLOCK = 16
+
+
+class ImageInfo(NamedTuple):
+    size: tuple
+    mode: str
+    format: str
+
+
+# /////////////////////
+# Headers
+# /////////////////////
+
+def read_header(path, length: int) -> bytes:
+    with open(path, "rb") as f:
+        return f.read(length)
+
+def tga_header(header: bytes) -> dict:
+    # None for files this module doesn't read itself: RLE, color mapped, 16 bit and mirrored images
+    if len(header) < TGA_HEADER:
+        return None
+    id_length, colormap_type, image_type = header[:3]
+    width, height, depth, descriptor = struct.unpack_from("<HHBB", header, 12)
+    modes = {(TGA_TRUECOLOR, 24): "RGB", (TGA_TRUECOLOR, 32): "RGBA", (TGA_GRAYSCALE, 8): "L"}
+    if colormap_type or (image_type, depth) not in modes or descriptor & TGA_RIGHT_TO_LEFT or not width or not height:
+        return None
+    return {"size": (width, height), "mode": modes[image_type, depth], "offset": TGA_HEADER + id_length,
+            "top_down": bool(descriptor & TGA_TOP_LEFT)}
+
+def dds_header(header: bytes) -> dict:
+    # None for anything but BC1, BC3 and 24/32 bit RGB(A) textures
+    if len(header) < DDS_HEADER or header[:4] != b"DDS " or struct.unpack_from("<I", header, 4)[0] != 124:
+        return None
+    height, width = struct.unpack_from("<II", header, 12)
+    flags, fourcc, bits = struct.unpack_from("<I4sI", header, 80)
+    masks = struct.unpack_from("<4I", header, 92)
+    info = {"size": (width, height), "offset": DDS_HEADER}
+    if flags & DDPF_FOURCC and fourcc == b"DX10":
+        if len(header) < DDS_HEADER + DDS_DX10_HEADER:
+            return None
+        dxgi_format = struct.unpack_from("<I", header, DDS_HEADER)[0]
+        info["offset"] += DDS_DX10_HEADER
+        fourcc = b"DXT1" if dxgi_format in DXGI_BC1 else b"DXT5" if dxgi_format in DXGI_BC3 else None
+        if dxgi_format in DXGI_RGBA8:
+            return {**info, "mode": "RGBA", "channels": (0, 1, 2, 3)}
+    if flags & DDPF_FOURCC and fourcc in (b"DXT1", b"DXT5"):
+        return {**info, "mode": "RGBA", "block": BC1_BLOCK if fourcc == b"DXT1" else BC3_BLOCK}
+    if flags & DDPF_RGB and bits in (24, 32):
+        # Byte offset of every channel, from its mask
+        shifts = {mask: index for index, mask in enumerate((0xFF, 0xFF00, 0xFF0000, 0xFF000000))}
+        channels = tuple(shifts.get(mask) for mask in masks[:bits // 8])
+        if None not in channels:
+            return {**info, "mode": "RGB" if bits == 24 else "RGBA", "channels": channels}
+    return None
+
+def png_header(header: bytes) -> dict:
+    if len(header) < 33 or header[:8] != PNG_SIGNATURE or header[12:16] != b"IHDR":
+        return None
+    width, height, depth, color_type = struct.unpack_from(">IIBB", header, 16)
+    if (depth, color_type) not in PNG_MODES:
+        return None
+    return {"size": (width, height), "mode": PNG_MODES[depth, color_type]}
+
+def probe(path) -> ImageInfo:
+    # Size and mode from the first bytes of the file, other formats are opened lazily by PIL
+    header = read_header(path, DDS_HEADER + DDS_DX10_HEADER)
+    for image_format, parse in (("PNG", png_header), ("DDS", dds_header)):
+        info = parse(header)
+        if info is not None:
+            return ImageInfo(info["size"], info["mode"], image_format)
+    if os.path.splitext(path)[1].lower() == ".tga":
+        # TGA has no signature, only trust the header for files named like one
+        info = tga_header(header)
+        if info is not None:
+            return ImageInfo(info["size"], info["mode"], "TGA")
+    with Image.open(path) as image:
+        return ImageInfo(image.size, image.mode, image.format)
+
+
+# /////////////////////
+# Readers
+# /////////////////////
+
+class ImageReader(ABC):
+    """ Horizontal bands of an image as (rows, width[, bands]) uint8 arrays in RGB(A) order """
+    def __init__(self, path, size: tuple, mode: str):
+        self.path = path
+        self.size = size
+        self.mode = mode
+
+    @abstractmethod
+    def rows(self, top: int, bottom: int) -> np.ndarray:
+        pass
+
+
+class RawReader(ImageReader):
+    """ Uncompressed pixels, memory-mapped. Bands are views into the file unless channels are reordered """
+    def __init__(self, path, size: tuple, mode: str, offset: int, channels: tuple, top_down: bool = True):
+        super().__init__(path, size, mode)
+        width, height = size
+        self.pixels = np.memmap(path, np.uint8, "r", offset, (height, width, len(channels)))
+        self.channels = channels
+        self.top_down = top_down
+
+    def rows(self, top: int, bottom: int) -> np.ndarray:
+        height = self.size[1]
+        band = self.pixels[top:bottom] if self.top_down else self.pixels[height - bottom:height - top][::-1]
+        if self.channels == (0,):
+            return band[..., 0]
+        if self.channels == tuple(range(len(self.channels))):
+            return band
+        if self.channels == (2, 1, 0):
+            return band[..., ::-1]
+        # BGRA and other orders can't be expressed as strides
+        return band[..., list(self.channels)]
+
+
+class BlockReader(ImageReader):
+    """ BC1 (DXT1) and BC3 (DXT5) blocks, memory-mapped and decoded one band of block rows at a time """
+    def __init__(self, path, size: tuple, offset: int, block: int):
+        super().__init__(path, size, "RGBA")
+        width, height = size
+        self.blocks = np.memmap(path, np.uint8, "r", offset, ((height + 3) // 4, (width + 3) // 4, block))
+
+    def rows(self, top: int, bottom: int) -> np.ndarray:
+        first, last = top // 4, min((bottom + 3) // 4, self.blocks.shape[0])
+        blocks = np.ascontiguousarray(self.blocks[first:last]).reshape(-1, self.blocks.shape[2])
+        if self.blocks.shape[2] == BC1_BLOCK:
+            pixels = decode_bc1(blocks)
+        else:
+            pixels = decode_bc1(blocks[:, 8:], four_colors=True)
+            pixels[..., 3] = decode_bc3_alpha(blocks[:, :8])
+        # (blocks, 16, 4) -> (block rows * 4, block columns * 4, 4)
+        columns = self.blocks.shape[1]
+        pixels = pixels.reshape(last - first, columns, 4, 4, 4).swapaxes(1, 2).reshape((last - first) * 4, columns * 4, 4)
+        return pixels[top - first * 4:bottom - first * 4, :self.size[0]]
+
+
+def open_reader(path) -> ImageReader:
+    # A fast path reader for the file, None if PIL has to decode it
+    header = read_header(path, DDS_HEADER + DDS_DX10_HEADER)
+    info = dds_header(header)
+    if info is None and os.path.splitext(path)[1].lower() == ".tga":
+        info = tga_header(header)
+        if info is not None:
+            info["channels"] = {"L": (0,), "RGB": (2, 1, 0), "RGBA": (2, 1, 0, 3)}[info["mode"]]
+    if info is None:
+        return None
+    width, height = info["size"]
+    if "block" in info:
+        length = ((width + 3) // 4) * ((height + 3) // 4) * info["block"]
+    else:
+        length = width * height * len(info["channels"])
+    if os.path.getsize(path) < info["offset"] + length:
+        # Truncated, PIL reports it
+        return None
+    if "block" in info:
+        return BlockReader(path, info["size"], info["offset"], info["block"])
+    return RawReader(path, info["size"], info["mode"], info["offset"], info["channels"], info.get("top_down", True))
+
+
+# /////////////////////
+# Block decoding
+# /////////////////////
+# Same integer math as PIL's BCn decoder, so both paths give the same pixels.
+
+def expand_565(packed: np.ndarray) -> np.ndarray:
+    packed = packed.astype(np.uint16)
+    r = (packed >> 11) & 31
+    g = (packed >> 5) & 63
+    b = packed & 31
+    return np.stack([(r << 3) | (r >> 2), (g << 2) | (g >> 4), (b << 3) | (b >> 2)], -1)
+
+def decode_bc1(blocks: np.ndarray, four_colors: bool = False) -> np.ndarray:
+    # (n, 8) color blocks -> (n, 16, 4) RGBA pixels. BC1 switches to three colors and
+    # transparent black when c0 <= c1, the color block of BC3 always has four colors
+    endpoints = blocks[:, :4].copy().view("<u2")
+    c0, c1 = expand_565(endpoints[:, 0]), expand_565(endpoints[:, 1])
+    four = (endpoints[:, 0] > endpoints[:, 1])[:, None] | four_colors
+    palette = np.full((len(blocks), 4, 4), 255, np.uint16)
+    palette[:, 0, :3] = c0
+    palette[:, 1, :3] = c1
+    palette[:, 2, :3] = np.where(four, (2 * c0 + c1) // 3, (c0 + c1) // 2)
+    palette[:, 3, :3] = np.where(four, (c0 + 2 * c1) // 3, 0)
+    palette[:, 3, 3] = np.where(four[:, 0], 255, 0)
+    bits = blocks[:, 4:].copy().view("<u4")
+    indices = (bits >> (2 * np.arange(16, dtype=np.uint32))) & 3
+    return np.take_along_axis(palette.astype(np.uint8), indices[..., None].astype(np.intp), 1)
+
+def decode_bc3_alpha(blocks: np.ndarray) -> np.ndarray:
+    # (n, 8) alpha blocks -> (n, 16) alpha, 8 interpolated values or 6 plus 0 and 255
+    a0, a1 = blocks[:, 0:1].astype(np.uint16), blocks[:, 1:2].astype(np.uint16)
+    steps = np.arange(1, 7, dtype=np.uint16)
+    eight = ((7 - steps) * a0 + steps * a1) // 7
+    six = ((5 - steps[:4]) * a0 + steps[:4] * a1) // 5
+    six = np.concatenate([six, np.zeros_like(a0), np.full_like(a0, 255)], 1)
+    palette = np.concatenate([a0, a1, np.where(a0 > a1, eight, six)], 1).astype(np.uint8)
+    bits = np.zeros((len(blocks), 8), np.uint8)
+    bits[:, :6] = blocks[:, 2:]
+    indices = (bits.view("<u8") >> (3 * np.arange(16, dtype=np.uint64))) & 7
+    return np.take_along_axis(palette, indices.astype(np.intp), 1)
@@ -0,0 +1,298 @@
+""" VPK (Valve pak) v1/v2 writer that updates an existing package in place
+
+Files are appended to the chunk archives (<name>_000.vpk, <name>_001.vpk, ...)
+as they're written, nothing is staged on disk. flush() writes the directory
+file (<name>_dir.vpk) with the CRC32 of every entry, and with VPK 2 the MD5
+sections. Opening an existing package loads its directory, so a later run only
+appends what changed. Chunks that lost entries to an update are compacted into
+a new chunk, chunks without changes are never rewritten.
+"""
+
+import hashlib
+import os
+import re
+import struct
+import threading
+import zlib
+from dataclasses import dataclass
+
+VPK_SIGNATURE = 0x55AA1234
+# Archive index of data stored in the directory file itself
+DIR_ARCHIVE = 0x7FFF
+ENTRY_TERMINATOR = 0xFFFF
+HEADER_V1 = struct.Struct("<3I")
+HEADER_V2 = struct.Struct("<7I")
+ENTRY = struct.Struct("<IHHIIH")
+MD5_ENTRY = struct.Struct("<3I16s")
+# Size the chunk archives are kept below, and the fraction of a chunk covered by one MD5 (VPK 2)
+CHUNK_SIZE = 200 * 2 ** 20
+MD5_FRACTION = 2 ** 20
+OTHER_MD5_SIZE = 48
+
+
+@dataclass
+class Entry:
+    crc: int
+    archive: int
+    offset: int
+    length: int
+
+
+def entry_name(name: str) -> str:
+    # Source looks files up case insensitively, with forward slashes
+    return name.replace("\\", "/").strip("/").lower()
+
+def split_name(name: str) -> tuple:
+    # (extension, folder, file name), empty parts are stored as a space
+    folder, _, file = name.rpartition("/")
+    stem, dot, extension = file.rpartition(".")
+    if not dot:
+        stem, extension = file, ""
+    return extension or " ", folder or " ", stem
+
+def read_string(data: bytes, offset: int) -> tuple:
+    end = data.index(b"\0", offset)
+    return data[offset:end].decode(), end + 1
+
+
+# /////////////////////
+# Directory
+# /////////////////////
+
+def build_tree(entries: dict) -> bytes:
+    tree = {}
+    for name, entry in entries.items():
+        extension, folder, stem = split_name(name)
+        tree.setdefault(extension, {}).setdefault(folder, []).append((stem, entry))
+    data = []
+    for extension in sorted(tree):
+        data.append(extension.encode() + b"\0")
+        for folder in sorted(tree[extension]):
+            data.append(folder.encode() + b"\0")
+            for stem, entry in sorted(tree[extension][folder], key=lambda item: item[0]):
+                data.append(stem.encode() + b"\0")
+                data.append(ENTRY.pack(entry.crc, 0, entry.archive, entry.offset, entry.length, ENTRY_TERMINATOR))
+            data.append(b"\0")
+        data.append(b"\0")
+    data.append(b"\0")
+    return b"".join(data)
+
+def read_directory(path) -> tuple:
+    # Returns (version, entries by name, MD5 fractions by archive) of a directory file
+    with open(path, "rb") as f:
+        data = f.read()
+    signature, version, tree_size = HEADER_V1.unpack_from(data)
+    if signature != VPK_SIGNATURE or version not in (1, 2):
+        raise ValueError(f"{path} is not a VPK 1 or 2 directory")
+    header = HEADER_V1.size if version == 1 else HEADER_V2.size
+    entries = {}
+    offset = header
+    while True:
+        extension, offset = read_string(data, offset)
+        if not extension:
+            break
+        while True:
+            folder, offset = read_string(data, offset)
+            if not folder:
+                break
+            while True:
+                stem, offset = read_string(data, offset)
+                if not stem:
+                    break
+                crc, preload, archive, entry_offset, length, _ = ENTRY.unpack_from(data, offset)
+                offset += ENTRY.size
+                if preload or archive == DIR_ARCHIVE:
+                    raise ValueError(f"{path} keeps file data in the directory, it can't be updated")
+                name = "/".join(part for part in (folder, stem) if part != " ")
+                entries[entry_name(name + ("" if extension == " " else f".{extension}"))] = \
+                    Entry(crc, archive, entry_offset, length)
+    fractions = {}
+    if version == 2:
+        _, _, _, data_size, md5_size, _, _ = HEADER_V2.unpack_from(data)
+        start = header + tree_size + data_size
+        for index in range(md5_size // MD5_ENTRY.size):
+            archive, fraction, length, digest = MD5_ENTRY.unpack_from(data, start + index * MD5_ENTRY.size)
+            fractions.setdefault(archive, {})[fraction] = (length, digest)
+    return version, entries, fractions
+
+
+# /////////////////////
+# Package
+# /////////////////////
+
+class VPKArchive:
+    """ A VPK package opened for writing, safe to write to from several threads
+
+    path is the directory file, it must end in _dir.vpk. Writes replace entries
+    of the same name. Until flush() the directory on disk still describes the
+    previous state, whose data is never overwritten.
+    """
+    def __init__(self, path, version: int = 2, chunk_size: int = CHUNK_SIZE):
+        self.path = str(path)
+        if not self.path.endswith("_dir.vpk"):
+            raise ValueError(f"The VPK directory file has to end in _dir.vpk: {self.path}")
+        self.base = self.path[:-len("_dir.vpk")]
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.version = version
+        self.chunk_size = chunk_size
+        self.entries: dict[str, Entry] = {}
+        self.fractions: dict[int, dict] = {}
+        if os.path.exists(self.path):
+            _, self.entries, self.fractions = read_directory(self.path)
+        self.lock = threading.Lock()
+        # Archives that lost entries and get compacted, and the first offset changed in each archive
+        self.stale: set[int] = set()
+        self.changed: dict[int, int] = {}
+        self.current = None
+        self.file = None
+
+    def chunk_path(self, archive: int) -> str:
+        return f"{self.base}_{archive:03}.vpk"
+
+    def free_archive(self) -> int:
+        # Lowest chunk number neither in use nor on disk
+        used = {entry.archive for entry in self.entries.values()} | {self.current}
+        archive = 0
+        while archive in used or os.path.exists(self.chunk_path(archive)):
+            archive += 1
+        return archive
+
+    def exists(self, name: str) -> bool:
+        return entry_name(name) in self.entries
+
+    def read(self, name: str) -> bytes:
+        entry = self.entries[entry_name(name)]
+        if self.file is not None and entry.archive == self.current:
+            # Appended data may still sit in the write buffer
+            self.file.flush()
+        with open(self.chunk_path(entry.archive), "rb") as f:
+            f.seek(entry.offset)
+            return f.read(entry.length)
+
+    def write(self, name: str, data: bytes):
+        crc = zlib.crc32(data)
+        with self.lock:
+            # Rewriting the same data leaves the entry and its chunk alone
+            previous = self.entries.get(entry_name(name))
+            if previous is not None and (previous.crc, previous.length) == (crc, len(data)) and self.read(name) == data:
+                return
+            archive, offset = self.append(data)
+            self.set_entry(entry_name(name), Entry(crc, archive, offset, len(data)))
+
+    def link(self, source: str, target: str):
+        # The target shares the data of the source entry
+        with self.lock:
+            self.set_entry(entry_name(target), self.entries[entry_name(source)])
+
+    def remove(self, name: str):
+        with self.lock:
+            entry = self.entries.pop(entry_name(name), None)
+            if entry is not None:
+                self.stale.add(entry.archive)
+
+    def set_entry(self, name: str, entry: Entry):
+        previous = self.entries.get(name)
+        if previous is not None and previous != entry:
+            self.stale.add(previous.archive)
+        self.entries[name] = entry
+
+    def last_chunk(self, size: int) -> int:
+        # The highest numbered chunk if the data fits and the chunk isn't compacted
+        archives = {entry.archive for entry in self.entries.values()}
+        if not archives:
+            return None
+        last = max(archives)
+        path = self.chunk_path(last)
+        if last in self.stale or not os.path.exists(path) or os.path.getsize(path) + size > self.chunk_size:
+            return None
+        return last
+
+    def append(self, data: bytes) -> tuple:
+        # New data goes to the end of the last chunk, a new one is started once it's full
+        if self.file is not None and self.file.tell() and self.file.tell() + len(data) > self.chunk_size:
+            self.file.close()
+            self.file = self.current = None
+        if self.file is None:
+            self.current = self.last_chunk(len(data))
+            if self.current is None:
+                self.current = self.free_archive()
+            self.file = open(self.chunk_path(self.current), "ab")
+        offset = self.file.tell()
+        self.file.write(data)
+        self.changed[self.current] = min(self.changed.get(self.current, offset), offset)
+        return self.current, offset
+
+    def compact(self, archive: int) -> int:
+        # Copies the data still in use to a new chunk, shared data stays shared
+        live = sorted({(entry.offset, entry.length) for entry in self.entries.values() if entry.archive == archive})
+        if not live:
+            return None
+        target = self.free_archive()
+        moved = {}
+        with open(self.chunk_path(archive), "rb") as source, open(self.chunk_path(target), "wb") as f:
+            for offset, length in live:
+                source.seek(offset)
+                moved[offset, length] = f.tell()
+                f.write(source.read(length))
+        for name, entry in self.entries.items():
+            if entry.archive == archive:
+                self.entries[name] = Entry(entry.crc, target, moved[entry.offset, entry.length], entry.length)
+        self.changed[target] = 0
+        return target
+
+    def flush(self):
+        """ Compacts the chunks that lost entries and writes the directory """
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+                self.current = None
+            for archive in sorted(self.stale):
+                self.compact(archive)
+            self.stale.clear()
+            used = {entry.archive for entry in self.entries.values()}
+            self.write_directory(used)
+            # Old chunks are only deleted once the directory doesn't point at them anymore,
+            # this also cleans up chunks of an interrupted run
+            folder, name = os.path.split(self.base)
+            pattern = re.compile(re.escape(name) + r"_(\d{3,})\.vpk")
+            for file in os.listdir(folder or "."):
+                match = pattern.fullmatch(file)
+                if match and int(match.group(1)) not in used:
+                    os.remove(os.path.join(folder, file))
+            self.changed.clear()
+
+    def close(self):
+        self.flush()
+
+    def update_fractions(self, archive: int) -> list:
+        # MD5 of every MD5_FRACTION bytes of a chunk, only the changed part is read again
+        size = os.path.getsize(self.chunk_path(archive))
+        changed = self.changed.get(archive, size)
+        kept = {start: value for start, value in self.fractions.get(archive, {}).items()
+                if start + value[0] <= changed and value[0] == MD5_FRACTION}
+        start = max((start + MD5_FRACTION for start in kept), default=0)
+        if start < size:
+            with open(self.chunk_path(archive), "rb") as f:
+                f.seek(start)
+                for offset in range(start, size, MD5_FRACTION):
+                    data = f.read(MD5_FRACTION)
+                    kept[offset] = (len(data), hashlib.md5(data).digest())
+        self.fractions[archive] = kept
+        return [MD5_ENTRY.pack(archive, start, length, digest) for start, (length, digest) in sorted(kept.items())]
+
+    def write_directory(self, archives: set):
+        tree = build_tree(self.entries)
+        if self.version == 1:
+            data = HEADER_V1.pack(VPK_SIGNATURE, 1, len(tree)) + tree
+        else:
+            self.fractions = {archive: value for archive, value in self.fractions.items() if archive in archives}
+            md5 = b"".join(b"".join(self.update_fractions(archive)) for archive in sorted(archives))
+            data = HEADER_V2.pack(VPK_SIGNATURE, 2, len(tree), 0, len(md5), OTHER_MD5_SIZE, 0) + tree + md5
+            data += hashlib.md5(tree).digest() + hashlib.md5(md5).digest()
+            # The last checksum covers everything before it
+            data += hashlib.md5(data).digest()
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,483 @@
+""" Native-code-free VTF 7.2 writer with vectorized DXT1/DXT5 block compression
+
+Used by FastValveMaterial when VTFLib is not available (or Encoder = python),
+everything here only needs numpy and works on any platform.
+"""
+
+import struct
+from enum import IntEnum, IntFlag
+from itertools import combinations_with_replacement
+
+import numpy as np
+
+
+class ImageFormat(IntEnum):
+    RGBA8888 = 0
+    DXT1 = 13
+    DXT5 = 15
+
+
+class ImageFlag(IntFlag):
+    NONE = 0
+    NORMAL = 0x80
+    EIGHTBITALPHA = 0x2000
+
+
+class Quality(IntEnum):
+    RANGE = 0  # Fast: endpoints from the extremes along the principal axis
+    CLUSTER = 1  # Slow: least squares endpoints for the best index clustering
+
+
+class MipFilter(IntEnum):
+    BOX = 0  # 2x2 average, fastest
+    KAISER = 1  # Kaiser windowed sinc, sharp with little ringing
+    LANCZOS = 2  # Lanczos-3, sharpest, can ring at hard edges
+
+
+# Radius of the windowed sinc filters in output pixels, and the Kaiser window shape
+FILTER_RADIUS = 3
+KAISER_ALPHA = 4.0
+VTF_VERSION = (7, 2)
+HEADER_SIZE = 80
+LOWRES_SIZE = 16
+# Blocks compressed per batch, keeps the cluster fit temporaries around 100 MB
+CHUNK_BLOCKS = 512
+
+
+# /////////////////////
+# Helpers
+# /////////////////////
+
+def nearest_power_of_two(size: int) -> int:
+    power = 1
+    while power < size:
+        power <<= 1
+    if power - size > size - power // 2:
+        power //= 2
+    return max(power, 1)
+
+def mipmap_count(width: int, height: int) -> int:
+    return max(width, height).bit_length()
+
+def downsample(image: np.ndarray) -> np.ndarray:
+    # 2x2 box filter, a side that is already 1 pixel wide is kept
+    h, w = image.shape[:2]
+    tmp = image.astype(np.uint16)
+    if h > 1:
+        tmp = tmp[0:h - 1:2] + tmp[1:h:2]
+    else:
+        tmp = tmp * 2
+    if w > 1:
+        tmp = tmp[:, 0:w - 1:2] + tmp[:, 1:w:2]
+    else:
+        tmp = tmp * 2
+    tmp += 2
+    tmp >>= 2
+    return tmp.astype(np.uint8)
+
+def compute_reflectivity(mipmaps: list) -> tuple:
+    # Average linear color, taken from the first level small enough to be cheap
+    sample = next(level for level in mipmaps if level.shape[0] * level.shape[1] <= 64 * 64)
+    linear = (sample[..., :3].reshape(-1, 3) / 255.0) ** 2.2
+    return tuple(float(x) for x in linear.mean(0))
+
+def data_size(width: int, height: int, image_format: ImageFormat) -> int:
+    if image_format == ImageFormat.RGBA8888:
+        return width * height * 4
+    blocks = ((width + 3) // 4) * ((height + 3) // 4)
+    return blocks * (8 if image_format == ImageFormat.DXT1 else 16)
+
+
+# /////////////////////
+# Mipmaps
+# /////////////////////
+
+def filter_weights(mip_filter: MipFilter) -> np.ndarray:
+    # Taps of the 2:1 reduction, source pixels sit at ±0.25, ±0.75, ... output pixels from the center
+    if mip_filter == MipFilter.BOX:
+        return np.array([0.5, 0.5], np.float32)
+    x = (np.arange(4 * FILTER_RADIUS) - (4 * FILTER_RADIUS - 1) / 2) / 2
+    if mip_filter == MipFilter.KAISER:
+        window = np.i0(KAISER_ALPHA * np.sqrt(1 - (x / FILTER_RADIUS) ** 2)) / np.i0(KAISER_ALPHA)
+    else:
+        window = np.sinc(x / FILTER_RADIUS)
+    weights = np.sinc(x) * window
+    return (weights / weights.sum()).astype(np.float32)
+
+def reduce_rows(rows: np.ndarray, weights: np.ndarray) -> np.ndarray:
+    # Halves the width of float rows, edge pixels are repeated past the borders
+    width = rows.shape[1]
+    if width == 1:
+        return rows
+    pad = len(weights) // 2 - 1
+    if pad:
+        rows = np.pad(rows, ((0, 0), (pad, pad), (0, 0)), mode="edge")
+    out = rows[:, 0:width - 1:2] * weights[0]
+    for tap, weight in enumerate(weights[1:], 1):
+        out += rows[:, tap:tap + width // 2 * 2:2] * weight
+    return out
+
+def normalize_normals(image: np.ndarray) -> np.ndarray:
+    # Rescales the RGB encoded vectors of a filtered normal map back to unit length
+    vectors = image[..., :3] / np.float32(127.5) - 1
+    length = np.sqrt(np.einsum("...i,...i->...", vectors, vectors))[..., None]
+    vectors = np.where(length > 1e-6, vectors / np.maximum(length, 1e-6), np.array([0, 0, 1], np.float32))
+    image[..., :3] = np.clip(np.rint((vectors + 1) * 127.5), 0, 255)
+    return image
+
+def alpha_coverage(alpha: np.ndarray, reference: int, scale: float = 1.0) -> float:
+    # Share of pixels that pass an alpha test at reference once alpha is scaled and rounded
+    return np.count_nonzero(np.rint(alpha * scale) > reference) / alpha.size
+
+def scale_alpha(image: np.ndarray, reference: int, coverage: float) -> np.ndarray:
+    # Scales the alpha of a level so as many pixels pass the alpha test as in the top level
+    alpha = image[..., 3].astype(np.float32)
+    low, high = 0.0, 4.0
+    for _ in range(16):
+        scale = (low + high) / 2
+        if alpha_coverage(alpha, reference, scale) < coverage:
+            low = scale
+        else:
+            high = scale
+    image = image.copy()
+    image[..., 3] = np.clip(np.rint(alpha * high), 0, 255)
+    return image
+
+
+class MipChain:
+    """ Builds every mip level of an RGBA image from bands of its top level, fed top to bottom
+
+    Each level is filtered from the previous one as soon as enough of its rows
+    are known, so only the filter support plus a few rows per level stay in
+    memory. With alpha coverage on, levels below the top are held until they're
+    complete because their alpha scale depends on the whole level.
+    """
+    def __init__(self, width: int, height: int, mip_filter: MipFilter = MipFilter.BOX, normal_map: bool = False,
+                 alpha_reference: int = 0):
+        self.mip_filter = mip_filter
+        self.weights = filter_weights(mip_filter)
+        self.normal_map = normal_map
+        self.alpha_reference = alpha_reference
+        self.sizes = [(max(width >> i, 1), max(height >> i, 1)) for i in range(mipmap_count(width, height))]
+        self.received = [0] * len(self.sizes)
+        # Rows of each level that the next level still needs, and the index of the first one
+        self.buffers = [None] * len(self.sizes)
+        self.first = [0] * len(self.sizes)
+        self.held = {}
+        self.covered = 0
+
+    def write(self, rows: np.ndarray) -> list:
+        """ Feed the next rows of the top level, returns the (level, rows) bands this completes """
+        bands = []
+        self._write(rows, 0, bands)
+        return bands
+
+    def _write(self, rows: np.ndarray, level: int, bands: list):
+        width, height = self.sizes[level]
+        self.received[level] += len(rows)
+        self.emit(rows, level, bands)
+        if level + 1 == len(self.sizes):
+            return
+        buffer = rows if self.buffers[level] is None else np.concatenate([self.buffers[level], rows])
+        done = self.received[level] >= height
+        next_height = self.sizes[level + 1][1]
+        taps = len(self.weights) if height > 1 else 1
+        pad = taps // 2 - 1 if height > 1 else 0
+        produced = self.received[level + 1]
+        # Rows of the next level whose whole filter support has arrived
+        last = next_height if done else min((self.received[level] - taps + pad) // 2 + 1, next_height)
+        if last > produced:
+            self._write(self.reduce(buffer, self.first[level], height, produced, last), level + 1, bands)
+        keep = max(min(2 * last - pad, height) - self.first[level], 0) if height > 1 else len(buffer)
+        self.buffers[level] = None if done else buffer[keep:]
+        self.first[level] += 0 if done else keep
+
+    def reduce(self, buffer: np.ndarray, first: int, height: int, top: int, bottom: int) -> np.ndarray:
+        # Rows top to bottom of the next level from the buffered rows of this one
+        if height == 1:
+            sources = [buffer]
+        else:
+            pad = len(self.weights) // 2 - 1
+            out_rows = np.arange(top, bottom)
+            sources = [buffer[np.clip(2 * out_rows - pad + tap, 0, height - 1) - first]
+                       for tap in range(len(self.weights))]
+        if self.mip_filter == MipFilter.BOX:
+            # Integer path, the pairs of rows are interleaved again for downsample()
+            if len(sources) == 1:
+                image = downsample(sources[0])
+            else:
+                pairs = np.stack(sources, 1).reshape((-1,) + sources[0].shape[1:])
+                image = downsample(pairs)
+        else:
+            if len(sources) == 1:
+                rows = sources[0].astype(np.float32)
+            else:
+                rows = sources[0] * self.weights[0]
+                for source, weight in zip(sources[1:], self.weights[1:]):
+                    rows += source * weight
+            image = np.clip(np.rint(reduce_rows(rows, self.weights)), 0, 255).astype(np.uint8)
+        if self.normal_map:
+            image = normalize_normals(image)
+        return image
+
+    def emit(self, rows: np.ndarray, level: int, bands: list):
+        if not self.alpha_reference:
+            bands.append((level, rows))
+            return
+        if level == 0:
+            self.covered += np.count_nonzero(rows[..., 3] > self.alpha_reference)
+            bands.append((level, rows))
+            return
+        self.held.setdefault(level, []).append(rows)
+        if self.received[level] >= self.sizes[level][1]:
+            width, height = self.sizes[0]
+            image = np.concatenate(self.held.pop(level))
+            bands.append((level, scale_alpha(image, self.alpha_reference, self.covered / (width * height))))
+
+
+def generate_mipmaps(image: np.ndarray, mip_filter: MipFilter = MipFilter.BOX, normal_map: bool = False,
+                     alpha_reference: int = 0) -> list:
+    levels = {}
+    for level, rows in MipChain(image.shape[1], image.shape[0], mip_filter, normal_map, alpha_reference).write(image):
+        levels.setdefault(level, []).append(rows)
+    return [np.concatenate(levels[level]) for level in sorted(levels)]
+
+
+# /////////////////////
+# Block compression
+# /////////////////////
+
+def to_blocks(image: np.ndarray) -> np.ndarray:
+    # (H, W, C) -> (N, 16, C), edge pixels are repeated for partial blocks
+    h, w = image.shape[:2]
+    pad_h, pad_w = -h % 4, -w % 4
+    if pad_h or pad_w:
+        image = np.pad(image, ((0, pad_h), (0, pad_w), (0, 0)), mode="edge")
+        h, w = image.shape[:2]
+    c = image.shape[2]
+    return image.reshape(h // 4, 4, w // 4, 4, c).swapaxes(1, 2).reshape(-1, 16, c)
+
+def quantize_565(colors: np.ndarray) -> np.ndarray:
+    # float RGB -> packed 565
+    c = np.clip(np.rint(colors), 0, 255).astype(np.uint32)
+    r = (c[..., 0] * 31 + 127) // 255
+    g = (c[..., 1] * 63 + 127) // 255
+    b = (c[..., 2] * 31 + 127) // 255
+    return (r << 11) | (g << 5) | b
+
+def expand_565(packed: np.ndarray) -> np.ndarray:
+    r = (packed >> 11) & 31
+    g = (packed >> 5) & 63
+    b = packed & 31
+    return np.stack([(r << 3) | (r >> 2), (g << 2) | (g >> 4), (b << 3) | (b >> 2)], -1).astype(np.float32)
+
+def principal_axis(colors: np.ndarray):
+    # Power iteration on the per-block covariance, colors: (N, 16, 3) float32
+    mean = colors.mean(1, keepdims=True)
+    centered = colors - mean
+    covariance = np.einsum("nki,nkj->nij", centered, centered)
+    axis = np.ones(colors.shape[0:1] + (3,), np.float32)
+    for _ in range(8):
+        axis = np.einsum("nij,nj->ni", covariance, axis)
+        axis /= np.maximum(np.abs(axis).max(1, keepdims=True), 1e-12)
+    axis /= np.maximum(np.linalg.norm(axis, axis=1, keepdims=True), 1e-12)
+    return centered, axis
+
+def range_fit(colors: np.ndarray):
+    centered, axis = principal_axis(colors)
+    projection = np.einsum("nki,ni->nk", centered, axis)
+    rows = np.arange(colors.shape[0])
+    start = colors[rows, projection.argmax(1)]
+    end = colors[rows, projection.argmin(1)]
+    return quantize_565(start), quantize_565(end)
+
+# All ways to split 16 points, ordered along the axis, into 4 runs
+_PARTITIONS = np.array(list(combinations_with_replacement(range(17), 3)), np.int64).T
+
+def cluster_fit(colors: np.ndarray):
+    centered, axis = principal_axis(colors)
+    order = np.einsum("nki,ni->nk", centered, axis).argsort(1)
+    ordered = np.take_along_axis(colors, order[..., None], 1)
+    prefix = np.concatenate([np.zeros_like(ordered[:, :1]), ordered.cumsum(1)], 1)
+    i, j, k = _PARTITIONS
+    n0, n1, n2, n3 = i, j - i, k - j, 16 - k
+    alpha2 = (n0 + n1 * 4 / 9 + n2 / 9).astype(np.float32)[:, None]
+    beta2 = (n3 + n1 / 9 + n2 * 4 / 9).astype(np.float32)[:, None]
+    alphabeta = ((n1 + n2) * 2 / 9).astype(np.float32)[:, None]
+    s0 = prefix[:, i]
+    s1 = prefix[:, j] - s0
+    s2 = prefix[:, k] - prefix[:, j]
+    s3 = prefix[:, 16:17] - prefix[:, k]
+    alphax = s0 + s1 * (2 / 3) + s2 * (1 / 3)
+    betax = s3 + s1 * (1 / 3) + s2 * (2 / 3)
+    det = alpha2 * beta2 - alphabeta * alphabeta
+    with np.errstate(divide="ignore", invalid="ignore"):
+        a = (alphax * beta2 - betax * alphabeta) / det
+        b = (betax * alpha2 - alphax * alphabeta) / det
+    a = expand_565(quantize_565(np.nan_to_num(a)))
+    b = expand_565(quantize_565(np.nan_to_num(b)))
+    # Squared error of each split, minus the constant sum of x^2
+    error = (a * a * alpha2 + b * b * beta2
+             + 2 * (a * b * alphabeta - a * alphax - b * betax)).sum(-1)
+    error[:, det[:, 0] == 0] = np.inf
+    best = error.argmin(1)
+    rows = np.arange(colors.shape[0])
+    return quantize_565(a[rows, best]), quantize_565(b[rows, best])
+
+def color_indices(colors: np.ndarray, c0: np.ndarray, c1: np.ndarray):
+    # Orders the endpoints for 4 color mode and picks the nearest palette entry
+    swap = c0 < c1
+    c0, c1 = np.where(swap, c1, c0), np.where(swap, c0, c1)
+    e0, e1 = expand_565(c0), expand_565(c1)
+    palette = np.stack([e0, e1, (2 * e0 + e1) / 3, (e0 + 2 * e1) / 3], 1)
+    distance = ((colors[:, :, None, :] - palette[:, None, :, :]) ** 2).sum(-1)
+    indices = distance.argmin(2).astype(np.uint32)
+    indices[c0 == c1] = 0
+    return c0, c1, indices
+
+def compress_color(colors: np.ndarray, quality: Quality) -> np.ndarray:
+    # (N, 16, 3) uint8 -> (N, 8) DXT1 color blocks
+    out = np.empty(len(colors), np.dtype([("c0", "<u2"), ("c1", "<u2"), ("indices", "<u4")]))
+    fit = cluster_fit if quality == Quality.CLUSTER else range_fit
+    shifts = np.arange(16, dtype=np.uint32) * 2
+    for start in range(0, len(colors), CHUNK_BLOCKS):
+        chunk = colors[start:start + CHUNK_BLOCKS].astype(np.float32)
+        c0, c1, indices = color_indices(chunk, *fit(chunk))
+        out["c0"][start:start + CHUNK_BLOCKS] = c0
+        out["c1"][start:start + CHUNK_BLOCKS] = c1
+        out["indices"][start:start + CHUNK_BLOCKS] = (indices << shifts).sum(1)
+    return out.view(np.uint8).reshape(-1, 8)
+
+def alpha_palette(a0: np.ndarray, a1: np.ndarray) -> np.ndarray:
+    a0, a1 = a0.astype(np.int32)[:, None], a1.astype(np.int32)[:, None]
+    eight = np.concatenate([a0, a1] + [((7 - i) * a0 + i * a1) // 7 for i in range(1, 7)], 1)
+    six = np.concatenate([a0, a1] + [((5 - i) * a0 + i * a1) // 5 for i in range(1, 5)]
+                         + [np.zeros_like(a0), np.full_like(a0, 255)], 1)
+    return np.where(a0 > a1, eight, six)
+
+def alpha_indices(alpha: np.ndarray, a0: np.ndarray, a1: np.ndarray):
+    palette = alpha_palette(a0, a1)
+    distance = np.abs(alpha[:, :, None] - palette[:, None, :])
+    indices = distance.argmin(2)
+    return indices, np.take_along_axis(distance, indices[..., None], 2)[..., 0].sum(1)
+
+def compress_alpha(alpha: np.ndarray, quality: Quality) -> np.ndarray:
+    # (N, 16) uint8 -> (N, 8) DXT5 alpha blocks
+    alpha = alpha.astype(np.int32)
+    a0, a1 = alpha.max(1), alpha.min(1)
+    indices, error = alpha_indices(alpha, a0, a1)
+    if quality == Quality.CLUSTER:
+        # Also try the 6 value mode with explicit 0 and 255, fit to the values in between
+        inner = np.where((alpha > 0) & (alpha < 255), alpha, -1)
+        b1 = np.where(inner.max(1) < 0, 0, inner.max(1))
+        b0 = np.where(inner.max(1) < 0, 0, np.where(inner < 0, 256, inner).min(1))
+        six_indices, six_error = alpha_indices(alpha, b0, b1)
+        better = six_error < error
+        a0, a1 = np.where(better, b0, a0), np.where(better, b1, a1)
+        indices[better] = six_indices[better]
+    bits = (indices.astype(np.uint64) << (np.arange(16, dtype=np.uint64) * 3)).sum(1, dtype=np.uint64)
+    out = np.empty((len(alpha), 8), np.uint8)
+    out[:, 0] = a0
+    out[:, 1] = a1
+    out[:, 2:] = bits.astype("<u8").view(np.uint8).reshape(-1, 8)[:, :6]
+    return out
+
+def compress(image: np.ndarray, image_format: ImageFormat, quality: Quality = Quality.RANGE) -> bytes:
+    if image_format == ImageFormat.RGBA8888:
+        return np.ascontiguousarray(image).tobytes()
+    blocks = to_blocks(image)
+    color = compress_color(blocks[..., :3], quality)
+    if image_format == ImageFormat.DXT1:
+        return color.tobytes()
+    return np.concatenate([compress_alpha(blocks[..., 3], quality), color], 1).tobytes()
+
+
+# /////////////////////
+# VTF container
+# /////////////////////
+
+class VTFStream:
+    """ Encodes a VTF from horizontal bands of the top level, fed top to bottom
+
+    The mip levels come from a MipChain and each one is compressed 4 rows at a
+    time as soon as those rows are available, so apart from the compressed data
+    only a few rows per level are held in memory. on_level, if given, is called
+    with every (level, rows) band before it's compressed.
+    """
+    def __init__(self, width: int, height: int, image_format: ImageFormat, flags: ImageFlag = ImageFlag.NONE,
+                 quality: Quality = Quality.RANGE, mip_filter: MipFilter = MipFilter.BOX, normal_map: bool = False,
+                 alpha_reference: int = 0, on_level=None):
+        self.image_format = image_format
+        self.flags = flags
+        self.quality = quality
+        self.chain = MipChain(width, height, mip_filter, normal_map, alpha_reference)
+        self.sizes = self.chain.sizes
+        self.on_level = on_level
+        self.received = [0] * len(self.sizes)
+        self.pending = [None] * len(self.sizes)
+        self.data = [[] for _ in self.sizes]
+        # Small levels are also kept uncompressed for the thumbnail and reflectivity
+        self.small = {}
+
+    def write(self, rows: np.ndarray):
+        for level, band in self.chain.write(rows):
+            if self.on_level is not None:
+                self.on_level(level, band)
+            self.encode(band, level)
+
+    def encode(self, rows: np.ndarray, level: int):
+        width, height = self.sizes[level]
+        self.received[level] += len(rows)
+        if self.pending[level] is not None:
+            rows = np.concatenate([self.pending[level], rows])
+        done = self.received[level] >= height
+        usable = len(rows) if done else len(rows) // 4 * 4
+        self.pending[level] = rows[usable:] if usable < len(rows) else None
+        if usable == 0:
+            return
+        rows = rows[:usable]
+        self.data[level].append(compress(rows, self.image_format, self.quality))
+        if width * height <= 64 * 64:
+            self.small.setdefault(level, []).append(rows)
+
+    def getvalue(self, first_level: int = 0) -> bytes:
+        # A first level > 0 gives a smaller VTF that starts at that mip level, from the
+        # same compressed data
+        if self.received[-1] < self.sizes[-1][1]:
+            raise ValueError("VTF image data is incomplete")
+        small = [np.concatenate(self.small[level]) for level in sorted(self.small) if level >= first_level]
+        lowres = next(level for level in small if max(level.shape[:2]) <= LOWRES_SIZE)
+        width, height = self.sizes[first_level]
+        header = struct.pack("<4s2IIHHIHH4x3f4xfIBIBBH",
+                             b"VTF\0", *VTF_VERSION, HEADER_SIZE,
+                             width, height, int(self.flags), 1, 0,
+                             *compute_reflectivity(small), 1.0,
+                             int(self.image_format), len(self.sizes) - first_level,
+                             int(ImageFormat.DXT1), lowres.shape[1], lowres.shape[0], 1)
+        data = [header.ljust(HEADER_SIZE, b"\0"), compress(lowres, ImageFormat.DXT1, self.quality)]
+        # Mipmaps are stored from the smallest to the largest
+        for level in reversed(range(first_level, len(self.sizes))):
+            if sum(len(band) for band in self.data[level]) != data_size(*self.sizes[level], self.image_format):
+                raise ValueError(f"VTF mip level {level} has the wrong size")
+            data.extend(self.data[level])
+        return b"".join(data)
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            f.write(self.getvalue())
+
+
+def write_vtf(image: np.ndarray, image_format: ImageFormat, flags: ImageFlag = ImageFlag.NONE,
+              quality: Quality = Quality.RANGE, mip_filter: MipFilter = MipFilter.BOX, normal_map: bool = False,
+              alpha_reference: int = 0) -> bytes:
+    """ Encode a (H, W, 4) uint8 RGBA image with power of two sides into VTF bytes """
+    stream = VTFStream(image.shape[1], image.shape[0], image_format, flags, quality, mip_filter, normal_map,
+                       alpha_reference)
+    stream.write(image)
+    return stream.getvalue()
+
+def save_vtf(path, image: np.ndarray, image_format: ImageFormat, flags: ImageFlag = ImageFlag.NONE,
+             quality: Quality = Quality.RANGE, mip_filter: MipFilter = MipFilter.BOX, normal_map: bool = False,
+             alpha_reference: int = 0):
+    with open(path, "wb") as f:
+        f.write(write_vtf(image, image_format, flags, quality, mip_filter, normal_map, alpha_reference))
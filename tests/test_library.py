@@ -0,0 +1,40 @@
+""" Tests for the in-memory library API (convert_material) """
+
+import numpy as np
+import pytest
+
+import FastValveMaterial as fvm
+
+SIZE = 64
+
+
+def maps() -> dict:
+    rng = np.random.default_rng(7)
+    gradient = np.linspace(0, 255, SIZE, dtype=np.float32)
+    return {"color": rng.integers(0, 256, (SIZE, SIZE, 3), dtype=np.uint8),
+            "normal": np.full((SIZE, SIZE, 3), (128, 128, 255), np.uint8),
+            "ao": np.broadcast_to(gradient, (SIZE, SIZE)).astype(np.uint8),
+            "roughness": np.broadcast_to(gradient[:, None], (SIZE, SIZE)).astype(np.uint8),
+            "metallic": (rng.random((SIZE, SIZE)) > 0.5).astype(np.uint8) * 255}
+
+
+def vtf_size(data: bytes) -> tuple:
+    return int.from_bytes(data[16:18], "little"), int.from_bytes(data[18:20], "little")
+
+
+def test_orm_setting_routes_channels():
+    split = maps()
+    orm = np.stack([split["ao"], split["roughness"], split["metallic"]], -1)
+    settings = {"encoder": "python"}
+    expected = fvm.convert_material(split, settings)
+    outputs = fvm.convert_material({"color": split["color"], "normal": split["normal"], "orm": orm},
+                                   {**settings, "orm": True})
+    # Metallic and gloss come from the G and B channels, so _m isn't the uniform default
+    assert vtf_size(outputs["material_m.vtf"]) == (SIZE, SIZE)
+    for name in ("material_c.vtf", "material_n.vtf", "material_m.vtf"):
+        assert outputs[name] == expected[name]
+
+
+def test_unknown_preset_is_rejected():
+    with pytest.raises(ValueError):
+        fvm.Config(None).update({"preset": "missing"})